@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# Fills a database with a synthetic conference for load tests (see load.py).
+# WARNING: This replaces all events, rooms and slides in the selected database.
+# Use a throwaway database, for example the one started by bench/postgres.sh.
+
+import os
+import sys
+import uuid
+import random
+import argparse
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from infopage import Infopage
+
+DATASET_NS = uuid.UUID('6ba7b810-9dad-11d1-80b4-dddddddddddd')
+
+def generate(count, rooms, start):
+    """
+    Generate a synthetic event list in the format expected by Infopage.update().
+
+    Each room gets back-to-back sessions of 20 to 55 minutes with short breaks,
+    starting at the given time, so some events are running and many are upcoming
+    at any time during the conference.
+    """
+    clocks = [ start ] * rooms
+    events = [ ]
+    for i in range(count):
+        room = i % rooms
+        begins = clocks[room]
+        ends = begins + timedelta(minutes=random.choice((20, 25, 40, 45, 55)))
+        clocks[room] = ends + timedelta(minutes=random.choice((5, 10, 15)))
+        events.append({
+            'id': uuid.uuid5(DATASET_NS, str(i)),
+            'name': u"Session {i} in room {room}".format(i=i, room=room + 1),
+            'venue_id': room + 1,
+            'venue': u"Room {room}".format(room=room + 1),
+            'active': True,
+            'start_time': begins,
+            'end_time': ends,
+        })
+    return events
+
+def playlist(rooms, pattern):
+    """
+    Build a slide order from a list of master numbers.
+
+    The pattern is repeated until every room has been shown once. Masters 0 and 1
+    show the next room in turn, any other master is not associated with a room.
+    """
+    order = [ ]
+    room = 0
+    while room < rooms:
+        for master in pattern:
+            if master in (0, 1):
+                if room < rooms:
+                    order.append({ 'room': room + 1, 'master': master })
+                    room += 1
+            else:
+                order.append({ 'room': None, 'master': master })
+        if not any(master in (0, 1) for master in pattern):
+            break
+    return order
+
+parser = argparse.ArgumentParser(description="Generate a synthetic dataset (replaces all events, rooms and slides!)")
+parser.add_argument("-f", "--config", help="specifies the configuration file name (default is /etc/infopage.conf)")
+parser.add_argument("-d", "--database", required=True, help="specifies the PostgreSQL database name (use a throwaway database)")
+parser.add_argument("-u", "--user", help="specifies the database user name")
+parser.add_argument("-r", "--host", help="specifies the database host (local if not set)")
+parser.add_argument("-p", "--password", help="specifies the database password (passwordless login if not set)")
+parser.add_argument("-m", "--rooms", type=int, default=20, help="number of rooms (default: 20)")
+parser.add_argument("-n", "--events", type=int, default=2000, help="number of events (default: 2000)")
+parser.add_argument("-s", "--slides", default="0,0,2", help="comma separated pattern of masters for the slide order, see content.py (default: 0,0,2)")
+parser.add_argument("-b", "--before", type=float, default=2, help="hours between the start of the conference and now (default: 2)")
+parser.add_argument("-S", "--seed", type=int, default=0, help="random seed, runs with the same seed generate the same data (default: 0)")
+args = parser.parse_args()
+
+db = Infopage()
+db.loadconfig(args.config)
+db.setconfig('dbname', args.database)
+if args.user:
+    db.setconfig('dbuser', args.user)
+if args.host:
+    db.setconfig('dbhost', args.host)
+if args.password:
+    db.setconfig('dbpassword', args.password)
+
+random.seed(args.seed)
+start = datetime.now().replace(second=0, microsecond=0) - timedelta(hours=args.before)
+events = generate(args.events, args.rooms, start)
+order = playlist(args.rooms, [ int(m) for m in args.slides.split(',') ])
+
+with db:
+    db.createschema()
+    db.migrate()
+    if db.setting('time_format') is None:
+        # a fresh database, see schema.py -d
+        db.insertdefault()
+    db.clear(True)
+    db.update(events)
+    db.slides(order)
+    db.publish()
+print("{0} rooms, {1} events, {2} slides".format(args.rooms, len(events), len(order)))
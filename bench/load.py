@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+# Load test for the slide endpoint.
+# Runs the same request pattern against one or more servers, for example the
+# mod_python setup and the WSGI application, and reports throughput and latency:
+#
+#   bench/load.py http://localhost/content.py/slide http://localhost:8080/content.py/slide
+#
+# By default, every client requests consecutive slides as fast as possible.
+# With --interval, each client behaves like a display running fade.js instead:
+# it requests the next slide every few seconds and sends the entity tags of
+# the slides it already has. With --database, the results are also broken
+# down by the master of each slide.
+
+import os
+import sys
+import time
+import random
+import threading
+import argparse
+import collections
+import requests
+from datetime import datetime
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from infopage import Infopage
+
+# names of the masters in content.py, by master number
+MASTERS = [ 'EventMaster (now)', 'EventMaster', 'NowMaster' ]
+# number of entity tags remembered per display, like in fade.js
+ETAGS = 16
+
+def percentile(values, fraction):
+    """Return the value at the given fraction (0..1) of a sorted list."""
+    if len(values) == 0:
+        return float('nan')
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+def loadmasters(args):
+    """Return the master number of each slide in sequence order, read from the database."""
+    db = Infopage()
+    db.loadconfig(args.config)
+    db.setconfig('dbname', args.database)
+    if args.user:
+        db.setconfig('dbuser', args.user)
+    if args.host:
+        db.setconfig('dbhost', args.host)
+    if args.password:
+        db.setconfig('dbpassword', args.password)
+    now = datetime.now()
+    with db:
+        return [ slide['master'] for slide in db.playlist(now, now)['slides'] ]
+
+def client(url, deadline, interval, masters, results, errors, offset):
+    """
+    Request consecutive slides until the deadline.
+
+    With an interval, one slide is requested every interval seconds, with
+    conditional requests like fade.js. Otherwise, slides are requested as fast
+    as possible. Each response is recorded as a tuple (master, latency, status).
+    """
+    session = requests.Session()
+    etags = collections.OrderedDict()
+    # the first slide of a display is the one after 0
+    counter = offset + 1
+    # displays are not switched on at the same time
+    due = time.time() + random.uniform(0, interval)
+    while True:
+        if interval > 0:
+            if due >= deadline:
+                break
+            time.sleep(max(0, due - time.time()))
+            due += interval
+        elif time.time() >= deadline:
+            break
+        headers = { }
+        if interval > 0 and len(etags) > 0:
+            headers['If-None-Match'] = ', '.join(etags)
+        master = None
+        if len(masters) > 0:
+            master = masters[counter % len(masters)]
+        start = time.time()
+        try:
+            r = session.get(url, params={ 'slide': counter }, headers=headers)
+            if r.status_code not in (200, 304):
+                errors.append(r.status_code)
+            else:
+                results.append((master, time.time() - start, r.status_code))
+                etag = r.headers.get('ETag')
+                if r.status_code == 200 and etag:
+                    etags.pop(etag, None)
+                    etags[etag] = True
+                    while len(etags) > ETAGS:
+                        etags.popitem(last=False)
+        except requests.RequestException as e:
+            errors.append(str(e))
+        counter += 1
+
+def summarize(results, elapsed):
+    """Return the statistics of a list of (master, latency, status) tuples."""
+    latencies = sorted([ latency for master, latency, status in results ])
+    return {
+        'requests': len(latencies),
+        'notmodified': len([ status for master, latency, status in results if status == 304 ]),
+        'rate': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+    }
+
+def run(url, clients, duration, interval, masters):
+    """
+    Run a load test against a single URL.
+    Returns the number of errors and the statistics of all requests and of each master.
+    """
+    results = [ ]
+    errors = [ ]
+    deadline = time.time() + duration
+    threads = [ threading.Thread(target=client, args=(url, deadline, interval, masters, results, errors, i)) for i in range(clients) ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    bymaster = { }
+    for result in results:
+        if result[0] is not None:
+            bymaster.setdefault(result[0], [ ]).append(result)
+    return len(errors), summarize(results, elapsed), dict([ (master, summarize(r, elapsed)) for master, r in bymaster.items() ])
+
+def report(result, name):
+    print("{requests:>10} {notmodified:>8} {errors:>8} {rate:>10.1f} {p50:>10.1f} {p95:>10.1f} {p99:>10.1f}  {name}".format(
+        name=name, requests=result['requests'], notmodified=result['notmodified'], errors=result.get('errors', ''), rate=result['rate'],
+        p50=result['p50'] * 1000, p95=result['p95'] * 1000, p99=result['p99'] * 1000))
+
+parser = argparse.ArgumentParser(description="Measure requests/s and latency of the slide endpoint")
+parser.add_argument("url", nargs='+', help="slide endpoint URLs to compare, without the query string")
+parser.add_argument("-c", "--clients", type=int, default=16, help="number of concurrent clients or displays (default: 16)")
+parser.add_argument("-t", "--duration", type=float, default=30, help="duration of each run in seconds (default: 30)")
+parser.add_argument("-i", "--interval", type=float, default=0, help="seconds between two slides of a display, 10 like index.html (default: 0, as fast as possible)")
+parser.add_argument("-f", "--config", help="specifies the configuration file name (default is /etc/infopage.conf)")
+parser.add_argument("-d", "--database", help="reports the latency of each master, using the slide order from this PostgreSQL database")
+parser.add_argument("-u", "--user", help="specifies the database user name")
+parser.add_argument("-r", "--host", help="specifies the database host (local if not set)")
+parser.add_argument("-p", "--password", help="specifies the database password (passwordless login if not set)")
+args = parser.parse_args()
+
+masters = [ ]
+if args.database:
+    masters = loadmasters(args)
+
+print("{0:>10} {1:>8} {2:>8} {3:>10} {4:>10} {5:>10} {6:>10}  {7}".format("requests", "304", "errors", "req/s", "p50 [ms]", "p95 [ms]", "p99 [ms]", "url"))
+for url in args.url:
+    errors, total, bymaster = run(url, args.clients, args.duration, args.interval, masters)
+    total['errors'] = errors
+    report(total, url)
+    for master in sorted(bymaster):
+        name = MASTERS[master] if master < len(MASTERS) else "master {0}".format(master)
+        report(bymaster[master], "  " + name)
@@ -0,0 +1,37 @@
+#!/bin/sh
+
+# Runs a command against a throwaway PostgreSQL server.
+# The server is created in a temporary directory, listens only on a Unix socket
+# and is deleted when the command exits. The database and user are both named
+# infopage, so the scripts and content.py work without a configuration file.
+#
+# Example, measuring the slide endpoint of the WSGI application:
+#
+#   bench/postgres.sh sh -c 'bench/dataset.py -d infopage && (python wsgi.py 8080 & sleep 1; bench/load.py -d infopage -c 200 -i 10 -t 60 http://localhost:8080/content.py/slide; kill $!)'
+
+set -e
+
+if [ $# -eq 0 ]; then
+	echo "Usage: bench/postgres.sh command [arguments...]" >&2
+	exit 1
+fi
+
+# initdb and pg_ctl are not in the PATH on Debian
+PGBIN=$(ls -d /usr/lib/postgresql/*/bin 2>/dev/null | sort -V | tail -n 1)
+if [ -n "$PGBIN" ]; then
+	PATH="$PGBIN:$PATH"
+fi
+
+ROOT=$(cd "$(dirname "$0")/.." && pwd)
+DATA=$(mktemp -d)
+trap 'pg_ctl -D "$DATA/db" -m immediate stop >/dev/null 2>&1 || true; rm -rf "$DATA"' EXIT
+
+initdb -D "$DATA/db" -U infopage -A trust >/dev/null
+pg_ctl -D "$DATA/db" -o "-c listen_addresses='' -c unix_socket_directories='$DATA'" -w -l "$DATA/postgres.log" start >/dev/null
+
+export PGHOST="$DATA"
+export PGUSER=infopage
+createdb infopage
+(cd "$ROOT" && python schema.py -d)
+
+"$@"
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# Compares the statement-per-event and the batched path of Infopage.update().
+# WARNING: This clears all events and rooms in the selected database.
+# Use a throwaway database, for example: createdb infopage_bench
+
+import os
+import sys
+import time
+import uuid
+import argparse
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from infopage import Infopage
+
+BENCH_NS = uuid.UUID('6ba7b810-9dad-11d1-80b4-bbbbbbbbbbbb')
+
+def generate(count, rooms):
+    """Generate a synthetic event list in the format expected by Infopage.update()."""
+    start = datetime(2016, 1, 1, 8, 0)
+    events = [ ]
+    for i in range(count):
+        room = i % rooms
+        begins = start + timedelta(minutes=30 * (i // rooms))
+        events.append({
+            'id': uuid.uuid5(BENCH_NS, str(i)),
+            'name': u"Session {i}".format(i=i),
+            'venue_id': room + 1,
+            'venue': u"Room {room}".format(room=room + 1),
+            'active': True,
+            'start_time': begins,
+            'end_time': begins + timedelta(minutes=25),
+        })
+    return events
+
+def measure(db, events, bulk):
+    """Return the time taken by an update() call, in seconds."""
+    start = time.time()
+    db.update(events, bulk=bulk)
+    return time.time() - start
+
+parser = argparse.ArgumentParser(description="Benchmark Infopage.update() (destroys all events and rooms!)")
+parser.add_argument("-f", "--config", help="specifies the configuration file name (default is /etc/infopage.conf)")
+parser.add_argument("-d", "--database", required=True, help="specifies the PostgreSQL database name (use a throwaway database)")
+parser.add_argument("-u", "--user", help="specifies the database user name")
+parser.add_argument("-r", "--host", help="specifies the database host (local if not set)")
+parser.add_argument("-p", "--password", help="specifies the database password (passwordless login if not set)")
+parser.add_argument("-n", "--sizes", default="1000,10000,100000", help="comma separated list of event counts (default: 1000,10000,100000)")
+parser.add_argument("-m", "--rooms", type=int, default=20, help="number of rooms (default: 20)")
+parser.add_argument("-s", "--skip-rowwise", help="only measure the batched path", action="store_true")
+args = parser.parse_args()
+
+db = Infopage()
+db.loadconfig(args.config)
+db.setconfig('dbname', args.database)
+if args.user:
+    db.setconfig('dbuser', args.user)
+if args.host:
+    db.setconfig('dbhost', args.host)
+if args.password:
+    db.setconfig('dbpassword', args.password)
+
+paths = [ ('bulk', True) ]
+if not args.skip_rowwise:
+    paths.insert(0, ('rowwise', False))
+
+with db:
+    db.createschema()
+    db.migrate()
+    print("{0:>8} {1:>8} {2:>12} {3:>12} {4:>12}".format("events", "path", "insert [s]", "update [s]", "events/s"))
+    for size in [ int(n) for n in args.sizes.split(',') ]:
+        events = generate(size, args.rooms)
+        for name, bulk in paths:
+            db.clear(True)
+            inserting = measure(db, events, bulk)
+            # the second pass hits existing events and rooms only
+            updating = measure(db, events, bulk)
+            rate = 2 * size / (inserting + updating)
+            print("{0:>8} {1:>8} {2:>12.3f} {3:>12.3f} {4:>12.0f}".format(size, name, inserting, updating, rate))
+    db.clear(True)
@@ -1,25 +1,33 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import csv
-import psycopg2
 import argparse
 import uuid
+import itertools
+import multiprocessing
 from datetime import datetime
 from zlib import adler32
-from infopage import Infopage
+from infopage import ConflictError, SYNC_LOCK, database
 
 CSV_NS = uuid.UUID('6ba7b810-9dad-11d1-80b4-cccccccccccc')
 CSV_FIELDS = [ 'location', 'event', 'start', 'end' ]
 CSV_DATEFMT = '%Y-%m-%d %H:%M'
-def read_csv(csvfile):
-    events = []
+def read_csv(csvfile, verbose=False):
+    """
+    Generate events from a CSV file, one row at a time.
+    
+    Event IDs are derived from the row contents, so importing the same
+    file again produces the same events.
+    """
     with open(csvfile, 'rb') as input:
         records = csv.DictReader(input, dialect='excel', fieldnames=CSV_FIELDS)
         for record in records:
-            if record['event'] is not '' and record['location'] is not '':
+            if record['event'] != '' and record['location'] != '':
+                key = '\x1f'.join([ record[field] for field in CSV_FIELDS ])
                 event = {
-                    'id': uuid.uuid4(),
+                    'id': uuid.uuid5(CSV_NS, key),
                     'name': record['event'],
                     'venue_id': adler32(record['location']),
                     'venue': record['location'].decode('utf-8'),
@@ -27,57 +35,146 @@ def read_csv(csvfile):
                     'start_time': datetime.strptime(record['start'], CSV_DATEFMT),
                     'end_time': datetime.strptime(record['end'], CSV_DATEFMT),
                 }
-                print("{event}".format(event=event))
-                events.append(event)
-    return events
+                if verbose:
+                    print("{event}".format(event=event))
+                yield event
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-i", "--input", help="the CSV file to read")
-parser.add_argument("-f", "--config", help="specifies the configuration file name (default is /etc/infopage.conf)")
-parser.add_argument("-d", "--database", help="specifies the PostgreSQL database name")
-parser.add_argument("-u", "--user", help="specifies the database user name")
-parser.add_argument("-r", "--host", help="specifies the database host (local if not set)")
-parser.add_argument("-p", "--password", help="specifies the database password (passwordless login if not set)")
-parser.add_argument("-o", "--overwrite", help="starts with a fresh event list (rooms and slides will be kept)", action="store_true")
-parser.add_argument("-c", "--clear", help="clears all events, rooms and slides (use this before the first import)", action="store_true")
-parser.add_argument("-l", "--list", help="lists all rooms", action="store_true")
-parser.add_argument("-s", "--slides", help="stores a slide order into the database, separated by a comma, specify -1 for the 'now' slide (use the -l option to list the slide numbers)")
-args = parser.parse_args()
+def parse_csv(csvfile):
+    """Parse and validate a complete CSV file, for use in a process pool."""
+    try:
+        return list(read_csv(csvfile))
+    except (ValueError, csv.Error) as e:
+        raise ValueError("{csvfile}: {error}".format(csvfile=csvfile, error=str(e)))
 
-db = Infopage()
-db.loadconfig(args.config)
-if args.database:
-    db.setconfig('dbname', args.database)
-if args.user:
-    db.setconfig('dbuser', args.user)
-if args.host:
-    db.setconfig('dbhost', args.host)
-if args.password:
-    db.setconfig('dbpassword', args.password)
+def input_files(inputs):
+    """Expand a list of file and directory names into a list of CSV files."""
+    files = [ ]
+    for name in inputs:
+        if os.path.isdir(name):
+            files.extend(sorted([ os.path.join(name, entry) for entry in os.listdir(name) if entry.lower().endswith('.csv') ]))
+        else:
+            files.append(name)
+    return files
 
-with db:
-    if args.list:
-        rooms = db.rooms()
-        print("Rooms:");
-        for r in rooms:
-            print(u"{id}, {name}".format(id=r['id'], name=r['name']))
+def check_venues(events):
+    """Raise a ConflictError if two different venue names hash to the same room ID."""
+    venues = { }
+    for event in events:
+        rid = event['venue_id'] & 0x7fffffff
+        venue = venues.setdefault(rid, event['venue'])
+        if venue != event['venue']:
+            raise ConflictError(u"Venues '{first}' and '{second}' have the same room ID {rid}".format(first=venue, second=event['venue'], rid=rid))
 
-    elif args.slides:
-        slides = args.slides.split(',')
-        order = [ ]
-        for s in slides:
-            if int(s) == -1:
-                order.append({ 'room': None, 'master': 2 })
-            else:
-                order.append({ 'room': int(s), 'master': 0 })
-        db.slides(order)
+def chunks(iterable, size):
+    """Split an iterable into lists of at most size elements."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
 
-    else:
-        if args.overwrite:
-            db.clear()
-        if args.clear:
-            db.clear(True)
+def main():
+    """Parse the command line and run the import."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", nargs='+', help="the CSV files to read, or directories containing them")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(), help="number of CSV files parsed in parallel (default: number of CPUs)")
+    parser.add_argument("-f", "--config", help="specifies the configuration file name (default is /etc/infopage.conf)")
+    parser.add_argument("-d", "--database", help="specifies the PostgreSQL database name")
+    parser.add_argument("-u", "--user", help="specifies the database user name")
+    parser.add_argument("-r", "--host", help="specifies the database host (local if not set)")
+    parser.add_argument("-p", "--password", help="specifies the database password (passwordless login if not set)")
+    parser.add_argument("-o", "--overwrite", help="deletes events that are not in the CSV file (rooms and slides will be kept)", action="store_true")
+    parser.add_argument("-c", "--clear", help="clears all events, rooms and slides (use this before the first import)", action="store_true")
+    parser.add_argument("-l", "--list", help="lists all rooms", action="store_true")
+    parser.add_argument("-b", "--batch", type=int, default=5000, help="number of events written per transaction (default: 5000, ignored with -o)")
+    parser.add_argument("-v", "--verbose", help="prints every imported event and the number of changes", action="store_true")
+    parser.add_argument("-s", "--slides", help="stores a slide order into the database, separated by a comma, specify -1 for the 'now' slide (use the -l option to list the slide numbers)")
+    args = parser.parse_args()
 
-        if args.input is not None:
-            events = read_csv(args.input)
-            db.update(events)
+    db = database(args.config)
+    if args.database:
+        db.setconfig('dbname', args.database)
+    if args.user:
+        db.setconfig('dbuser', args.user)
+    if args.host:
+        db.setconfig('dbhost', args.host)
+    if args.password:
+        db.setconfig('dbpassword', args.password)
+
+    with db:
+        if args.list:
+            rooms = db.rooms()
+            print("Rooms:");
+            for r in rooms:
+                print(u"{id}, {name}".format(id=r['id'], name=r['name']))
+
+        elif args.slides:
+            slides = args.slides.split(',')
+            order = [ ]
+            for s in slides:
+                if int(s) == -1:
+                    order.append({ 'room': None, 'master': 2 })
+                else:
+                    order.append({ 'room': int(s), 'master': 0 })
+            db.slides(order)
+            db.publish()
+
+        else:
+            # don't mix with a running sched.py, see Infopage.stage()
+            if not db.trylock(SYNC_LOCK):
+                sys.stderr.write("Another syncer is running, exiting.\n")
+                sys.exit(1)
+
+            if args.clear:
+                db.clear(True)
+
+            if args.input is not None:
+                files = input_files(args.input)
+                if len(files) == 1:
+                    events = read_csv(files[0], args.verbose)
+                else:
+                    # parse all files first, so venue collisions are caught before anything is written
+                    pool = multiprocessing.Pool(args.jobs)
+                    try:
+                        events = list(itertools.chain.from_iterable(pool.map(parse_csv, files)))
+                    finally:
+                        pool.terminate()
+                    check_venues(events)
+                    if args.verbose:
+                        for event in events:
+                            print("{event}".format(event=event))
+                if args.overwrite:
+                    # pruning needs the complete list in a single transaction
+                    counts = db.update(events, prune=True)
+                else:
+                    batches = chunks(events, args.batch)
+                    first = next(batches, [ ])
+                    second = next(batches, None)
+                    if second is None:
+                        # a single transaction is atomic already
+                        counts = db.update(first)
+                    else:
+                        # write the chunks into a new generation, so the display
+                        # switches to the complete import at once
+                        generation = db.stage()
+                        counts = { 'inserted': 0, 'updated': 0, 'deleted': 0 }
+                        for chunk in itertools.chain([ first, second ], batches):
+                            for key, value in db.update(chunk, generation=generation).items():
+                                counts[key] += value
+                        if sum(counts.values()) > 0:
+                            db.switch(generation)
+                        else:
+                            db.discard(generation)
+                if args.verbose:
+                    print("Inserted {inserted}, updated {updated}, deleted {deleted} events".format(**counts))
+            elif args.overwrite:
+                db.clear()
+
+            db.archive()
+            # publish once, so the snapshot never contains a partial import
+            db.publish()
+
+if __name__ == '__main__':
+    # worker processes import this module, they must not run the importer again
+    main()
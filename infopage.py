@@ -1,13 +1,51 @@
 #!/usr/bin/env python
 
 import sys
-import psycopg2
+import os
+import re
+import sqlite3
 import json
 import io
-# why is this not on by default?
-import psycopg2.extensions
-psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
-psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
+import threading
+import time
+import collections
+import select
+import bisect
+from datetime import datetime, timedelta
+try:
+    import psycopg2
+    import psycopg2.pool
+    # why is this not on by default?
+    import psycopg2.extensions
+    psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
+    psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
+except ImportError:
+    # only the SQLite backend is available
+    psycopg2 = None
+try:
+    # psycopg2 2.7 and later
+    from psycopg2.extras import execute_values
+except ImportError:
+    execute_values = None
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, see SqliteInfopage.trylock()
+    fcntl = None
+
+# errors raised by the database drivers, for callers that want to handle all of them
+DATABASE_ERRORS = (sqlite3.Error, )
+# errors that indicate a broken connection
+CONNECTION_ERRORS = (sqlite3.InterfaceError, )
+if psycopg2 is not None:
+    DATABASE_ERRORS += (psycopg2.Error, )
+    CONNECTION_ERRORS += (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+# advisory lock key that serializes all syncers and importers writing to the same database
+SYNC_LOCK = 0x5c4ed
+
+# master number of the "Happening right now" slide, which lists the running events of all rooms (see content.py)
+NOW_MASTER = 2
 
 class ConflictError(Exception):
     def __init__(self, value=""):
@@ -15,6 +53,336 @@ class ConflictError(Exception):
     def __str__(self):
         return repr(self.value)
 
+# Schema of the SQLite backend and of the read-only snapshot files written by Infopage.export()
+SQLITE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS config (
+        key text PRIMARY KEY,
+        value text
+    );
+    CREATE TABLE IF NOT EXISTS rooms (
+        id integer PRIMARY KEY,
+        name text NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS slides (
+        id integer PRIMARY KEY,
+        sequence_no integer NULL UNIQUE,
+        room integer NULL REFERENCES rooms,
+        master integer NOT NULL,
+        title text NULL,
+        max_rows integer NULL
+    );
+    CREATE TABLE IF NOT EXISTS events (
+        id integer PRIMARY KEY,
+        room integer NOT NULL REFERENCES rooms,
+        begins timestamp NOT NULL,
+        ends timestamp NOT NULL,
+        name text NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS events_ends ON events (ends);
+"""
+
+def insertrows(cur, table, columns, rows):
+    """
+    Insert a list of tuples into a table.
+    Uses multi-row VALUES lists if the driver supports it.
+    """
+    sql = "INSERT INTO {table} ({columns}) VALUES ".format(table=table, columns=", ".join(columns))
+    template = "(" + ", ".join([ "%s" ] * len(columns)) + ")"
+    if isinstance(cur, SqliteCursor):
+        cur.executemany(sql + template, rows)
+    elif execute_values is not None:
+        execute_values(cur, sql + "%s", rows, page_size=1000)
+    else:
+        # psycopg2 before 2.7: quote the rows like execute_values() does
+        for start in range(0, len(rows), 1000):
+            values = b", ".join([ cur.mogrify(template, row) for row in rows[start:start + 1000] ])
+            cur.execute(sql.encode('ascii') + values)
+
+class LRUCache(object):
+    """
+    A small thread-safe dictionary with a bounded number of entries.
+    When full, the least recently used entry is evicted.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.entries[key] = value
+            return value
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+    def __len__(self):
+        return len(self.entries)
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of PostgreSQL connections.
+    
+    Connections are opened on demand, up to maxconn, and kept open when they
+    are returned. If all of them are in use, getconn() waits for one to be
+    returned instead of failing right away.
+    """
+    def __init__(self, maxconn, timeout, **kwargs):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.kwargs = kwargs
+        self.idle = [ ]
+        self.used = 0
+        # time each idle connection was returned, keyed by id(connection)
+        self.lastused = { }
+        self.condition = threading.Condition()
+    def getconn(self):
+        """
+        Return an idle connection, or open a new one if the pool is not full.
+        Raises PoolError if no connection is returned within the timeout.
+        """
+        deadline = time.time() + self.timeout
+        with self.condition:
+            while len(self.idle) == 0 and self.used >= self.maxconn:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise psycopg2.pool.PoolError("Timed out waiting for a pooled connection")
+                self.condition.wait(remaining)
+            self.used += 1
+            if len(self.idle) > 0:
+                return self.idle.pop()
+        try:
+            return psycopg2.connect(**self.kwargs)
+        except:
+            with self.condition:
+                self.used -= 1
+                self.condition.notify()
+            raise
+    def putconn(self, conn, close=False):
+        """Return a connection to the pool, or close it and free its slot."""
+        with self.condition:
+            self.used -= 1
+            if close or conn.closed:
+                self.lastused.pop(id(conn), None)
+            else:
+                self.lastused[id(conn)] = time.time()
+                self.idle.append(conn)
+            self.condition.notify()
+        if close and not conn.closed:
+            conn.close()
+    def idletime(self, conn):
+        """Return the number of seconds since a connection was last returned, or None if it is new."""
+        with self.condition:
+            returned = self.lastused.pop(id(conn), None)
+        if returned is None:
+            return None
+        return time.time() - returned
+
+class Metrics(object):
+    """
+    Thread-safe counters and histograms, exported in the Prometheus text format.
+    
+    Each series is identified by a metric name and a tuple of (label, value)
+    pairs. Values are only kept in memory, so every process has its own.
+    """
+    # default histogram bucket upper bounds (seconds)
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    def __init__(self):
+        # metric name -> (type, help text, histogram buckets)
+        self.metrics = collections.OrderedDict()
+        # metric name -> { labels: value } for counters
+        # metric name -> { labels: [ bucket counts..., sum, count ] } for histograms
+        self.series = { }
+        self.lock = threading.Lock()
+    def describe(self, name, kind, text, buckets=BUCKETS):
+        """Declare a metric of the given kind ('counter' or 'histogram')."""
+        self.metrics[name] = (kind, text, buckets)
+        self.series.setdefault(name, { })
+    def increment(self, name, labels=(), value=1):
+        with self.lock:
+            series = self.series[name]
+            series[labels] = series.get(labels, 0) + value
+    def observe(self, name, labels, value):
+        buckets = self.metrics[name][2]
+        with self.lock:
+            series = self.series[name].get(labels)
+            if series is None:
+                series = [ 0 ] * (len(buckets) + 2)
+                self.series[name][labels] = series
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+    def render(self):
+        """Return all metrics as a list of lines in the Prometheus text format."""
+        def format(labels):
+            if len(labels) == 0:
+                return ''
+            return '{' + ','.join([ '{0}="{1}"'.format(key, value) for key, value in labels ]) + '}'
+        lines = [ ]
+        with self.lock:
+            for name, (kind, text, buckets) in self.metrics.items():
+                lines.append('# HELP {0} {1}'.format(name, text))
+                lines.append('# TYPE {0} {1}'.format(name, kind))
+                for labels, value in sorted(self.series[name].items()):
+                    if kind == 'histogram':
+                        for bound, count in zip(buckets, value):
+                            lines.append('{0}_bucket{1} {2}'.format(name, format(labels + (('le', repr(float(bound))), )), count))
+                        lines.append('{0}_bucket{1} {2}'.format(name, format(labels + (('le', '+Inf'), )), value[-1]))
+                        lines.append('{0}_sum{1} {2}'.format(name, format(labels), value[-2]))
+                        lines.append('{0}_count{1} {2}'.format(name, format(labels), value[-1]))
+                    else:
+                        lines.append('{0}{1} {2}'.format(name, format(labels), value))
+        return lines
+
+class EndTree(object):
+    """
+    Segment tree over a list of events sorted by start time.
+    
+    Each node holds the latest end time of its part of the list, so the events
+    that have not ended yet are found without visiting the ones that have,
+    no matter how long some of the events are.
+    """
+    def __init__(self, events):
+        self.events = events
+        self.size = 1
+        while self.size < len(events):
+            self.size *= 2
+        self.ends = [ None ] * (2 * self.size)
+        for i, e in enumerate(events):
+            self.ends[self.size + i] = e['ends']
+        for node in range(self.size - 1, 0, -1):
+            left, right = self.ends[2 * node], self.ends[2 * node + 1]
+            # the list is filled from the left, so right is only set if left is
+            self.ends[node] = left if right is None else max(left, right)
+    def find(self, now, last, limit=None):
+        """Return the events before position last that end at or after now, in list order."""
+        value = [ ]
+        stack = [ (1, 0, self.size) ]
+        while len(stack) > 0:
+            node, lo, hi = stack.pop()
+            if lo >= last or self.ends[node] is None or self.ends[node] < now:
+                continue
+            if hi - lo == 1:
+                value.append(self.events[lo])
+                if limit is not None and len(value) >= limit:
+                    break
+                continue
+            mid = (lo + hi) // 2
+            # visit the left half first
+            stack.append((2 * node + 1, mid, hi))
+            stack.append((2 * node, lo, mid))
+        return value
+
+class EventIndex(object):
+    """
+    In-memory index of events for the queries needed to render slides.
+    
+    Events are kept in arrays sorted by start time, globally and per room,
+    and looked up with bisection. Running events are found with an EndTree
+    over the events that started before the query time.
+    """
+    def __init__(self, events):
+        """
+        Build the index.
+        
+        Keyword arguments:
+        events -- a list of events in the following format:
+        [
+          { 'id': event_id, 'room': room_number, 'roomname': room_name, 'begins': begins, 'ends': ends, 'name': name },
+          ...
+        ]
+        """
+        self.events = sorted(events, key=lambda e: (e['begins'], e['id']))
+        self.begins = [ e['begins'] for e in self.events ]
+        self.tree = EndTree(self.events)
+        self.rooms = { }
+        for e in self.events:
+            room = self.rooms.setdefault(e['room'], ([ ], [ ]))
+            room[0].append(e['begins'])
+            room[1].append(e)
+        self.roomtrees = dict([ (room, EndTree(events)) for room, (begins, events) in self.rooms.items() ])
+    def running(self, now, limit=None, room=None):
+        """Return the events running at the given time, ordered by start time."""
+        if room is None:
+            begins, tree = self.begins, self.tree
+        elif room in self.rooms:
+            begins, tree = self.rooms[room][0], self.roomtrees[room]
+        else:
+            return [ ]
+        if limit is not None and limit <= 0:
+            return [ ]
+        return tree.find(now, bisect.bisect_right(begins, now), limit)
+    def upcoming(self, now, limit, room):
+        """Return the events in a room starting at or after the given time."""
+        begins, events = self.rooms.get(room, ([ ], [ ]))
+        first = bisect.bisect_left(begins, now)
+        if limit is None:
+            return events[first:]
+        return events[first:first + limit]
+
+def parsecounter(slidecounter):
+    """
+    Parse the slide counter sent by the client.
+    Returns None if it is missing, and its absolute value as an integer otherwise.
+    """
+    if slidecounter is None or slidecounter == '':
+        return None
+    return abs(int(slidecounter))
+
+def buildframe(settings, slides, index, slidecounter, now):
+    """
+    Assemble the result of Infopage.frame() from in-memory data.
+    
+    Keyword arguments:
+    settings -- the config table, as returned by Infopage.settings()
+    slides -- the active slides, keyed by sequence number
+    index -- an EventIndex
+    slidecounter -- the slide counter sent by the client
+    now -- the current time
+    """
+    value = {
+        'selector': { 'slide': None, 'master': None, 'title': None },
+        'slide': { 'name': None, 'room': None, 'maxrows': None },
+        'settings': settings,
+        'events': { 'now': None, 'after': [ ], 'current': [ ] },
+    }
+    room = None
+    master = None
+    limit = settings.get('max_rows')
+    counter = parsecounter(slidecounter)
+    if counter is not None and len(slides) > 0:
+        sequence_no = counter % len(slides)
+        slide = slides.get(sequence_no)
+        if slide is not None:
+            value['selector'] = { 'slide': sequence_no, 'master': slide['master'], 'title': slide['title'] }
+            master = slide['master']
+            room = slide['room']
+            if room is not None:
+                value['slide'] = { 'name': slide['roomname'], 'room': room, 'maxrows': slide['maxrows'] }
+            if slide['maxrows'] is not None:
+                limit = slide['maxrows']
+    if limit is not None:
+        limit = int(limit)
+    if master == NOW_MASTER:
+        value['events']['current'] = [ { 'begins': e['begins'], 'ends': e['ends'], 'name': e['name'], 'room': e['roomname'] } for e in index.running(now, limit) ]
+    if room is not None:
+        # the index is ordered by start time and id, like the queries of Infopage.frame()
+        running = index.running(now, 1, room)
+        if len(running) > 0:
+            value['events']['now'] = { 'begins': running[0]['begins'], 'ends': running[0]['ends'], 'name': running[0]['name'], 'room': None }
+        value['events']['after'] = [ { 'begins': e['begins'], 'ends': e['ends'], 'name': e['name'], 'room': None } for e in index.upcoming(now, limit, room) ]
+    return value
+
 class Infopage (object):
     """
     infopage database and API access abstraction
@@ -42,16 +410,108 @@ class Infopage (object):
     DEFAULT_DBNAME = "infopage"
     DEFAULT_DBPASSWORD = None
     DEFAULT_DBHOST = None
+    DEFAULT_BACKEND = "postgres"
+    DEFAULT_DBFILE = "/var/lib/infopage/infopage.db"
+    DEFAULT_POOLSIZE = 4
+    DEFAULT_POOLTIMEOUT = 10
+    # push streams pin a web server thread each, so they are disabled unless configured
+    DEFAULT_PUSHSTREAMS = 0
+    DEFAULT_SETTINGSTTL = 60
+    # first statement of export(), so all its queries see the same state of the database
+    EXPORT_TRANSACTION = "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY"
+    # number of events staged per round-trip by update()
+    UPDATE_BATCH = 1000
+    # notification channel for table changes, see createschema()
+    NOTIFY_CHANNEL = 'infopage'
+    # pooled connections idle for longer than this are checked before use (seconds)
+    POOL_CHECK_IDLE = 30
     
-    def __init__(self, configfile=None):
+    # Schema migrations, applied in order by migrate()
+    # Each entry is a tuple (schema version, SQL statements)
+    MIGRATIONS = [
+        (1, """
+            -- Upcoming events in a room: room = ? AND begins >= ? ORDER BY begins
+            CREATE INDEX events_room_begins ON events (room, begins);
+            -- Running event in a room: room = ? AND ends >= ? AND begins <= ?
+            CREATE INDEX events_room_ends ON events (room, ends);
+            -- Running events in all rooms: ends >= ? AND begins <= ? ORDER BY begins
+            CREATE INDEX events_ends_begins ON events (ends, begins);
+            -- slides.sequence_no is already covered by its UNIQUE constraint
+        """),
+        (2, """
+            -- Events that ended before the retention window, moved here by archive()
+            CREATE TABLE events_archive (
+                id integer PRIMARY KEY,
+                room integer NOT NULL,
+                begins timestamp NOT NULL,
+                ends timestamp NOT NULL,
+                name text NOT NULL
+            );
+        """),
+        (3, """
+            -- Events are stored in generations, see stage() and switch()
+            -- The existing events become generation 0
+            CREATE TABLE events_next (
+                generation integer NOT NULL,
+                id integer NOT NULL,
+                room integer NOT NULL REFERENCES rooms,
+                begins timestamp NOT NULL,
+                ends timestamp NOT NULL,
+                name text NOT NULL,
+                PRIMARY KEY (generation, id)
+            );
+            INSERT INTO events_next (generation, id, room, begins, ends, name)
+            SELECT 0, id, room, begins, ends, name FROM events;
+            DROP TABLE events;
+            ALTER TABLE events_next RENAME TO events;
+            CREATE INDEX events_room_begins ON events (generation, room, begins);
+            CREATE INDEX events_room_ends ON events (generation, room, ends);
+            CREATE INDEX events_ends_begins ON events (generation, ends, begins);
+            INSERT INTO config (key, value)
+            SELECT 'generation', '0' WHERE NOT EXISTS (SELECT 1 FROM config WHERE key = 'generation');
+            -- Readers only see the generation published in the config table
+            CREATE VIEW current_events AS
+            SELECT id, room, begins, ends, name FROM events
+            WHERE generation = (SELECT CAST(value AS integer) FROM config WHERE key = 'generation');
+        """),
+    ]
+    
+    # process-wide connection pools, keyed by connection parameters
+    pools = { }
+    # process-wide cache of the config table, keyed by connection parameters
+    # each entry is a tuple (load time, settings dictionary)
+    settingscache = { }
+    # number of active slides, keyed by connection parameters and data version
+    slidecounts = LRUCache(16)
+    # active slides and event indexes, keyed by connection parameters and data version
+    indexes = LRUCache(4)
+    # process-wide cache of parsed configuration files, keyed by file name
+    configcache = { }
+    lock = threading.Lock()
+    # process-wide instrumentation, see execute()
+    metrics = Metrics()
+    metrics.describe('infopage_query_seconds', 'histogram', "Duration of database transactions, by calling method")
+    metrics.describe('infopage_slow_queries_total', 'counter', "Database transactions slower than the slowquery setting, by calling method")
+    
+    def __init__(self, configfile=None, pooled=False):
         """
         Create a new infopage database access object.
         
         Keyword arguments:
         configfile -- a config file to load (if None or unset, no config is loaded)
+        pooled -- take connections from a process-wide pool instead of opening
+        a new one on every connect() (default: False)
         """
-        self.withwith = ('2.5' in psycopg2.__version__)
+        # connections and cursors are context managers since psycopg2 2.5
+        self.withwith = psycopg2 is not None and tuple(int(part) for part in re.findall(r'\d+', psycopg2.__version__)[:2]) >= (2, 5)
         self.conn = None
+        self.pooled = pooled
+        self.pool = None
+        self.broken = False
+        # set by bumpversion() during the current transaction, see execute()
+        self.bumped = False
+        # number of transactions executed through this object
+        self.queries = 0
         self.setdefaults()
         if configfile is not None:
             self.loadconfig(configfile)
@@ -70,18 +530,38 @@ class Infopage (object):
         Database settings do not automatically apply to open connections.
         
         Defaults:
+        backend = postgres
         database = infopage
+        database file = /var/lib/infopage/infopage.db (sqlite backend only)
         database user = infopage
         database password = (not used)
+        connection pool size = 4
+        connection pool timeout = 10 seconds
+        settings cache lifetime = 60 seconds
+        event index = disabled
+        snapshot file = (not used)
+        metrics = disabled
+        slow query log = disabled
+        push streams = 8 per process
         """
         self.config = {
+            'backend': Infopage.DEFAULT_BACKEND,
+            'dbfile': Infopage.DEFAULT_DBFILE,
             'dbuser': Infopage.DEFAULT_DBUSER,
             'dbname': Infopage.DEFAULT_DBNAME,
             'dbpassword': Infopage.DEFAULT_DBPASSWORD,
-            'dbhost': Infopage.DEFAULT_DBHOST
+            'dbhost': Infopage.DEFAULT_DBHOST,
+            'poolsize': Infopage.DEFAULT_POOLSIZE,
+            'pooltimeout': Infopage.DEFAULT_POOLTIMEOUT,
+            'settingsttl': Infopage.DEFAULT_SETTINGSTTL,
+            'eventindex': False,
+            'snapshot': None,
+            'metrics': False,
+            'slowquery': None,
+            'pushstreams': Infopage.DEFAULT_PUSHSTREAMS
         }
     
-    def loadconfig(self, configfile=None):
+    def loadconfig(self, configfile=None, cached=False):
         """
         Load settings from a JSON file.
         
@@ -100,16 +580,26 @@ class Infopage (object):
         will be raised. If opening an explicit configuration fails, the
         IOError is propagated.
         
+        If cached is set, the parsed file is kept for the lifetime of the
+        process and subsequent loads of the same file won't touch the
+        file system again.
+        
         Keyword arguments:
         configfile -- the name of the file to load (default: /etc/infopage.conf)
+        cached -- use the process-wide config cache (default: False)
         """
         realconfig = configfile
         if configfile is None:
             realconfig = Infopage.DEFAULT_CFGFILE
+        if cached and realconfig in Infopage.configcache:
+            self.config.update(Infopage.configcache[realconfig])
+            return
         try:
-            fh = io.open(realconfig, 'r')
-            config = json.load(fh)
+            with io.open(realconfig, 'r') as fh:
+                config = json.load(fh)
             self.config.update(config)
+            if cached:
+                Infopage.configcache[realconfig] = config
         except IOError as e:
             if configfile is None:
                 # ignore if the default config does not exist
@@ -126,54 +616,346 @@ class Infopage (object):
         Set a value in the configuration dictionary.
         
         Supported keys are:
+        backend -- postgres or sqlite (only used by database())
+        dbfile -- the database file of the sqlite backend
         dbuser -- the database user
         dbname -- the database name
         dbpassword -- the database login password (passwordless login is used if set to None)
         dbhost -- the database host (a local connection is used if set to None)
+        poolsize -- the maximum number of pooled connections per process
+        pooltimeout -- how long to wait for a pooled connection when all are in use (seconds)
+        settingsttl -- the maximum age of cached database settings (seconds)
+        eventindex -- render slides from an in-memory event index instead of querying the database
+        snapshot -- a file name for read-only snapshots, written by publish() and served by the display (see Snapshot)
+        metrics -- record the duration of every transaction (see Metrics)
+        slowquery -- log transactions that take longer than this (seconds, None to disable)
+        pushstreams -- the maximum number of push streams served by each web server process, 0 to disable them (see content.py)
         """
         self.config[key] = value
     
+    def connkey(self):
+        """Return a key identifying the database of the current settings."""
+        return (self.config['dbname'], self.config['dbuser'], self.config['dbpassword'], self.config['dbhost'])
+    
+    def getpool(self):
+        """
+        Return the process-wide connection pool for the current database settings,
+        creating it if necessary.
+        """
+        key = self.connkey()
+        with Infopage.lock:
+            pool = Infopage.pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(int(self.config['poolsize']), float(self.config['pooltimeout']), database=self.config['dbname'], user=self.config['dbuser'], password=self.config['dbpassword'], host=self.config['dbhost'])
+                Infopage.pools[key] = pool
+            return pool
+    
+    def checkconnection(self, conn):
+        """
+        Return True if a pooled connection is still usable.
+        
+        Connections that have been used recently are trusted without a round-trip,
+        failures during use are caught by execute() instead.
+        
+        The check doubles as a subscription to the change notification channel,
+        so fresh connections will receive cache invalidations.
+        """
+        if conn.closed:
+            return False
+        idle = self.pool.idletime(conn)
+        if idle is not None and idle < Infopage.POOL_CHECK_IDLE:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("LISTEN " + Infopage.NOTIFY_CHANNEL)
+            cur.close()
+            conn.commit()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+    
     def connect(self):
-        """Connect to the database"""
-        self.conn = psycopg2.connect(database=self.config['dbname'], user=self.config['dbuser'], password=self.config['dbpassword'], host=self.config['dbhost'])
+        """
+        Connect to the database.
+        
+        In pooled mode, a connection is taken from the process-wide pool
+        and checked for liveness first. Dead connections are discarded and
+        replaced by a fresh one.
+        """
+        self.broken = False
+        if psycopg2 is None:
+            raise ImportError("The PostgreSQL backend requires psycopg2, use the sqlite backend instead")
+        if self.pooled:
+            self.pool = self.getpool()
+            # try every connection the pool might hold, plus a fresh one
+            for attempt in range(int(self.config['poolsize']) + 1):
+                conn = self.pool.getconn()
+                if self.checkconnection(conn):
+                    self.conn = conn
+                    return
+                self.pool.putconn(conn, close=True)
+            raise psycopg2.OperationalError("Can't obtain a working connection from the pool")
+        else:
+            self.conn = psycopg2.connect(database=self.config['dbname'], user=self.config['dbuser'], password=self.config['dbpassword'], host=self.config['dbhost'])
     def close(self):
-        """Close the open database connection"""
+        """Close the open database connection, or return it to the pool."""
         if self.conn is not None:
-            self.conn.close()
+            if self.pool is not None:
+                try:
+                    if not self.conn.closed and not self.broken:
+                        self.conn.rollback()
+                except DATABASE_ERRORS:
+                    # the server has dropped the connection, don't reuse it
+                    self.broken = True
+                finally:
+                    # always give the slot back, or getconn() blocks once all are gone
+                    self.pool.putconn(self.conn, close=self.broken or bool(self.conn.closed))
+                    self.pool = None
+            else:
+                self.conn.close()
             self.conn = None
     
+    def listen(self):
+        """
+        Subscribe the current connection to change notifications.
+        Pooled connections are subscribed automatically.
+        """
+        def closure(cur):
+            cur.execute("LISTEN " + Infopage.NOTIFY_CHANNEL)
+        self.execute(closure, label='listen')
+    
+    def trylock(self, key):
+        """
+        Try to take a session-level advisory lock.
+        
+        Returns True if the lock was acquired. The lock is held until unlock()
+        is called or the connection is closed.
+        """
+        def closure(cur, key):
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (key, ))
+            return cur.fetchone()[0]
+        return self.execute(closure, key, label='trylock')
+    
+    def unlock(self, key):
+        """Release an advisory lock taken with trylock()."""
+        def closure(cur, key):
+            cur.execute("SELECT pg_advisory_unlock(%s)", (key, ))
+        self.execute(closure, key, label='unlock')
+    
+    def pollnotifies(self):
+        """
+        Process pending change notifications without a database round-trip.
+        
+        Returns the set of table names that were reported as changed.
+        Cached settings are dropped if the config table has changed.
+        """
+        changed = set()
+        if self.conn is None or self.conn.closed:
+            return changed
+        self.conn.poll()
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            if notify.channel == Infopage.NOTIFY_CHANNEL:
+                changed.add(notify.payload)
+        if 'config' in changed:
+            Infopage.settingscache.pop(self.connkey(), None)
+        return changed
+    
+    def wait(self, timeout):
+        """
+        Wait for change notifications on the current connection.
+        
+        listen() must have been called first. Returns the set of table names that
+        were reported as changed, or an empty set if the timeout expired.
+        
+        Keyword arguments:
+        timeout -- the maximum time to wait (seconds)
+        """
+        if self.conn.notifies:
+            return self.pollnotifies()
+        readable, writable, failed = select.select([ self.conn ], [ ], [ ], max(0, timeout))
+        if len(readable) > 0:
+            return self.pollnotifies()
+        return set()
+    
     def execute(self, closure, *args, **kwargs):
-        """Execute a statement closure inside a state monitor, if available."""
+        """
+        Execute a statement closure inside a state monitor, if available.
+        
+        If metrics or the slow query log are enabled, the duration is recorded
+        under the label keyword argument, normally the name of the calling
+        method. It is not passed on to the closure and defaults to the name
+        of the closure.
+        """
+        label = kwargs.pop('label', None) or closure.__name__
+        self.queries += 1
+        self.bumped = False
+        start = time.time()
+        try:
+            ret = self.transaction(closure, *args, **kwargs)
+        except CONNECTION_ERRORS:
+            # don't hand a dead connection back to the pool
+            self.broken = True
+            raise
+        finally:
+            if self.config['metrics'] or self.config['slowquery'] is not None:
+                self.measure(label, time.time() - start)
+        if self.bumped:
+            # the cached settings hold the old data version
+            Infopage.settingscache.pop(self.connkey(), None)
+        return ret
+    
+    def transaction(self, closure, *args, **kwargs):
+        """Run a statement closure in a transaction, see execute()."""
         if self.withwith:
             with self.conn:
                 with self.conn.cursor() as cur:
                     return closure(cur, *args, **kwargs)
         else:
             cur = self.conn.cursor()
-            ret = closure(cur, *args, **kwargs)
-            self.conn.commit()
-            cur.close()
+            try:
+                ret = closure(cur, *args, **kwargs)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            finally:
+                cur.close()
             return ret
     
+    def measure(self, kind, elapsed):
+        """Record the duration of a transaction, see execute()."""
+        labels = (('kind', kind), )
+        if self.config['metrics']:
+            Infopage.metrics.observe('infopage_query_seconds', labels, elapsed)
+        threshold = self.config['slowquery']
+        if threshold is not None and elapsed >= float(threshold):
+            Infopage.metrics.increment('infopage_slow_queries_total', labels)
+            sys.stderr.write("Slow query in {kind}: {elapsed:.1f} ms\n".format(kind=kind, elapsed=elapsed * 1000))
+    
+    def bumpversion(self, cur):
+        """
+        Increment the data version in the config table.
+        
+        Must be called from inside a statement closure after changing events,
+        rooms or slides. Readers use the data version to key their caches.
+        The cached settings of this process are dropped after the commit.
+        """
+        self.bumped = True
+        cur.execute("""
+            UPDATE config
+            SET value = CAST(CAST(value AS integer) + 1 AS text)
+            WHERE key = 'data_version'
+        """)
+        if cur.rowcount == 0:
+            cur.execute("""
+                INSERT INTO config (key, value) VALUES ('data_version', '1')
+            """)
+
+    def currentgeneration(self, cur):
+        """
+        Return the generation of the events table that is visible to readers.
+        Must be called from inside a statement closure.
+        """
+        cur.execute("SELECT CAST(value AS integer) FROM config WHERE key = 'generation'")
+        row = cur.fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def stage(self, copy=True):
+        """
+        Create a new generation of the events table.
+
+        The new generation is invisible to readers until switch() is called, so
+        it can be filled by any number of update() calls without affecting the
+        display. Generations left over by an aborted import are deleted.
+        The caller must hold SYNC_LOCK until switch() or discard(), since
+        changes written to the current generation in the meantime are lost.
+        Returns the number of the new generation.
+
+        Keyword arguments:
+        copy -- start with a copy of the current events (default: True)
+        """
+        def closure(cur, copy):
+            current = self.currentgeneration(cur)
+            cur.execute("DELETE FROM events WHERE generation > %s", (current, ))
+            generation = current + 1
+            if copy:
+                cur.execute("""
+                    INSERT INTO events (generation, id, room, begins, ends, name)
+                    SELECT %s, id, room, begins, ends, name FROM events
+                    WHERE generation = %s
+                """, (generation, current))
+            return generation
+        return self.execute(closure, copy, label='stage')
+
+    def switch(self, generation):
+        """
+        Make a generation created by stage() visible to readers.
+
+        The switch is a single config update. All other generations are deleted
+        afterwards in a separate transaction, readers that still use the old
+        generation keep their snapshot until they finish.
+        """
+        def closure(cur, generation):
+            cur.execute("UPDATE config SET value = %s WHERE key = 'generation'", (str(generation), ))
+            self.bumpversion(cur)
+        self.execute(closure, generation, label='switch')
+        def collect(cur, generation):
+            cur.execute("DELETE FROM events WHERE generation <> %s", (generation, ))
+        self.execute(collect, generation, label='switch')
+
+    def discard(self, generation):
+        """Delete a generation created by stage() without publishing it."""
+        def closure(cur, generation):
+            if generation == self.currentgeneration(cur):
+                raise ValueError("Can't discard the current generation")
+            cur.execute("DELETE FROM events WHERE generation = %s", (generation, ))
+        self.execute(closure, generation, label='discard')
+
+    def dataversion(self):
+        """Return the current data version (cached, see settings())."""
+        return int(self.settings().get('data_version') or 0)
+    
+    def activeslides(self):
+        """
+        Return the number of slides with a sequence number.
+        The count is cached for each data version.
+        """
+        key = (self.connkey(), self.dataversion())
+        count = Infopage.slidecounts.get(key)
+        if count is None:
+            def closure(cur):
+                cur.execute("SELECT COUNT(sequence_no) FROM slides WHERE sequence_no IS NOT NULL")
+                return cur.fetchone()[0]
+            count = self.execute(closure, label='activeslides')
+            Infopage.slidecounts.put(key, count)
+        return count
+    
     def clear(self, clearall=False):
         """
         Clear the events table, and optionally the slides and rooms too.
         
         Keyword arguments:
-        clearall -- also remove data from the slides and rooms tables
+        clearall -- also remove data from the slides, rooms and archive tables
         """
         def closure(cur):
             cur.execute("""
                 DELETE FROM events
             """)
             if clearall:
+                cur.execute("""
+                    DELETE FROM events_archive
+                """)
                 cur.execute("""
                     DELETE FROM slides
                 """)
                 cur.execute("""
                     DELETE FROM rooms
                 """)
-        self.execute(closure)
+            self.bumpversion(cur)
+        self.execute(closure, label='clear')
         
     def rooms(self):
         """Return the list of rooms and their unique ID."""
@@ -187,7 +969,7 @@ class Infopage (object):
                 ret.append({ 'id': r[0], 'name': r[1] })
             return ret
 
-        return self.execute(closure)
+        return self.execute(closure, label='rooms')
 
     def slides(self, slides):
         """
@@ -204,32 +986,31 @@ class Infopage (object):
             cur.execute("""
                 DELETE FROM slides
             """)
-            i = 0
-            for s in slides:
-                cur.execute("""
-                    INSERT INTO slides
-                    (master, room, sequence_no)
-                    VALUES (%(master)s, %(rid)s, %(seqid)s)
-                """, {
-                    'master': s['master'],
-                    'rid': s['room'],
-                    'seqid': i
-                })
-                i = i + 1
+            rows = [ (s['master'], s['room'], i) for i, s in enumerate(slides) ]
+            if len(rows) > 0:
+                insertrows(cur, 'slides', ('master', 'room', 'sequence_no'), rows)
+            self.bumpversion(cur)
 
-        return self.execute(closure, slides)
+        return self.execute(closure, slides, label='slides')
 
-    def update(self, events):
+    def update(self, events, bulk=True, prune=False, generation=None):
         """
         Update the events table.
         
-        As there is currently no reliable way to determine when events are deleted,
-        the events table should always be cleared before updating.
+        Inactive events are deleted. Events that are missing from the input are
+        only deleted if prune is set, which requires the complete event list.
+        Unchanged events are not written at all.
         
         The rooms table will be updated automatically if a venue does not exist yet.
+        If a venue exists with the same ID but a different name, ConflictError
+        is raised and nothing is written.
+        
+        By default, the rooms table is read once, the events are staged into a
+        temporary table in batches and merged with a few set-based statements.
+        The old statement-per-event path is still available with bulk=False.
         
         Keyword arguments:
-        events -- an event list in the following format:
+        events -- an event list or iterable in the following format:
         [
           {
             'id': unique_event_id [uuid.UUID],
@@ -242,8 +1023,30 @@ class Infopage (object):
           },
           ...
         ]
+        bulk -- use the batched write path (default: True)
+        prune -- delete all stored events that are not in the list (default: False)
+        generation -- write into a generation created by stage() instead of the
+        one visible to readers (default: None)
+        
+        Archived events are imported again if they end within the retention
+        window (see archive()), so rescheduled events aren't lost. Inactive
+        events are also deleted from the archive.
+        
+        Returns the number of events that were changed:
+        { 'inserted': count, 'updated': count, 'deleted': count }
         """
-        def closure(cur, events):
+        if prune and not bulk:
+            raise ValueError("Pruning is only supported by the batched write path")
+        window = self.retention()
+        cutoff = None
+        if window is not None:
+            cutoff = datetime.now() - window
+        def closure(cur, events, generation, cutoff):
+            current = self.currentgeneration(cur)
+            if generation is None:
+                generation = current
+            counts = { 'inserted': 0, 'updated': 0, 'deleted': 0 }
+            newrooms = 0
             for e in events:
                 eid = e['id'].int & 0x7fffffff
                 rid = e['venue_id'] & 0x7fffffff
@@ -264,57 +1067,209 @@ class Infopage (object):
                         'rid': rid,
                         'rname': e['venue']
                     })
+                    newrooms += 1
                 else:
                     if cur.fetchone()[1] != e['venue']:
                         # TODO Implement UPDATE if appropriate
                         raise ConflictError("Room exists, but ID and name don't match")
                 cur.execute("""
-                    SELECT id
+                    SELECT room, begins, ends, name
                     FROM events
-                    WHERE id = %(eid)s
+                    WHERE generation = %(gen)s AND id = %(eid)s
                 """, {
+                    'gen': generation,
                     'eid': eid
                 })
                 if cur.rowcount == 0:
+                    if not e['active'] or cutoff is None or e['end_time'] >= cutoff:
+                        cur.execute("DELETE FROM events_archive WHERE id = %(eid)s", { 'eid': eid })
                     if e['active']:
+                        # other archived events are not imported again
                         cur.execute("""
-                            INSERT INTO events (id, room, begins, ends, name)
-                            VALUES (%(eid)s, %(rid)s, %(begins)s, %(ends)s, %(ename)s)
+                            INSERT INTO events (generation, id, room, begins, ends, name)
+                            SELECT %(gen)s, %(eid)s, %(rid)s, %(begins)s, %(ends)s, %(ename)s
+                            WHERE NOT EXISTS (SELECT 1 FROM events_archive WHERE id = %(eid)s)
                         """, {
+                            'gen': generation,
                             'eid': eid,
                             'rid': rid,
                             'begins': e['start_time'],
                             'ends': e['end_time'],
                             'ename': e['name']
                         })
-                    else:
-                        cur.execute("DELETE FROM events WHERE id = %(eid)s", { 'eid': eid })
-                else:
+                        counts['inserted'] += cur.rowcount
+                elif not e['active']:
+                    cur.execute("DELETE FROM events WHERE generation = %(gen)s AND id = %(eid)s", { 'gen': generation, 'eid': eid })
+                    counts['deleted'] += 1
+                elif tuple(cur.fetchone()) != (rid, e['start_time'], e['end_time'], e['name']):
+                    counts['updated'] += 1
                     cur.execute("""
                         UPDATE events
                         SET room = %(rid)s, begins = %(begins)s, ends = %(ends)s, name = %(name)s
-                        WHERE id = %(eid)s
+                        WHERE generation = %(gen)s AND id = %(eid)s
                     """, {
+                        'gen': generation,
                         'eid': eid,
                         'rid': rid,
                         'begins': e['start_time'],
                         'ends': e['end_time'],
                         'name': e['name']
                     })
+            # a staged generation is published by switch()
+            if generation == current and (newrooms > 0 or sum(counts.values()) > 0):
+                self.bumpversion(cur)
+            return counts
         
-        self.execute(closure, events)
+        if bulk:
+            return self.execute(self.bulkupdate, events, prune, generation, cutoff, label='update')
+        else:
+            return self.execute(closure, events, generation, cutoff, label='update')
+    
+    def bulkupdate(self, cur, events, prune=False, generation=None, cutoff=None):
+        """
+        Statement closure for the batched path of update().
+        Archived events ending at or after the cutoff are imported again, all of them if it is None.
+        """
+        current = self.currentgeneration(cur)
+        if generation is None:
+            generation = current
+        cur.execute("SELECT id, name FROM rooms")
+        rooms = dict(cur.fetchall())
+        cur.execute("""
+            CREATE TEMPORARY TABLE incoming (
+                seq integer NOT NULL,
+                id integer NOT NULL,
+                room integer NOT NULL,
+                begins timestamp NOT NULL,
+                ends timestamp NOT NULL,
+                name text NOT NULL,
+                active boolean NOT NULL
+            ) ON COMMIT DROP
+        """)
+        columns = ('seq', 'id', 'room', 'begins', 'ends', 'name', 'active')
+        newrooms = [ ]
+        batch = [ ]
+        for seq, e in enumerate(events):
+            eid = e['id'].int & 0x7fffffff
+            rid = e['venue_id'] & 0x7fffffff
+            rname = rooms.get(rid)
+            if rname is None:
+                rooms[rid] = e['venue']
+                newrooms.append((rid, e['venue']))
+            elif rname != e['venue']:
+                # TODO Implement UPDATE if appropriate
+                raise ConflictError("Room exists, but ID and name don't match")
+            batch.append((seq, eid, rid, e['start_time'], e['end_time'], e['name'], bool(e['active'])))
+            if len(batch) >= Infopage.UPDATE_BATCH:
+                insertrows(cur, 'incoming', columns, batch)
+                batch = [ ]
+        if len(batch) > 0:
+            insertrows(cur, 'incoming', columns, batch)
+        if len(newrooms) > 0:
+            insertrows(cur, 'rooms', ('id', 'name'), newrooms)
+        counts = { 'inserted': 0, 'updated': 0, 'deleted': 0 }
+        cur.execute("""
+            -- if an event occurs more than once, the last occurrence wins
+            DELETE FROM incoming
+            USING incoming AS later
+            WHERE incoming.id = later.id AND incoming.seq < later.seq;
+            ANALYZE incoming;
+        """)
+        cur.execute("""
+            DELETE FROM events_archive
+            USING incoming
+            WHERE events_archive.id = incoming.id
+            AND (NOT incoming.active OR %(cutoff)s IS NULL OR incoming.ends >= %(cutoff)s)
+        """, { 'cutoff': cutoff })
+        if prune:
+            cur.execute("""
+                DELETE FROM events
+                WHERE events.generation = %s
+                AND NOT EXISTS (SELECT 1 FROM incoming WHERE incoming.id = events.id AND incoming.active)
+            """, (generation, ))
+        else:
+            cur.execute("""
+                DELETE FROM events
+                USING incoming
+                WHERE events.generation = %s AND events.id = incoming.id AND NOT incoming.active
+            """, (generation, ))
+        counts['deleted'] = cur.rowcount
+        cur.execute("""
+            UPDATE events
+            SET room = incoming.room, begins = incoming.begins, ends = incoming.ends, name = incoming.name
+            FROM incoming
+            WHERE events.generation = %s AND events.id = incoming.id AND incoming.active
+            AND (events.room, events.begins, events.ends, events.name) IS DISTINCT FROM (incoming.room, incoming.begins, incoming.ends, incoming.name)
+        """, (generation, ))
+        counts['updated'] = cur.rowcount
+        cur.execute("""
+            INSERT INTO events (generation, id, room, begins, ends, name)
+            SELECT %(gen)s, id, room, begins, ends, name
+            FROM incoming
+            WHERE active AND NOT EXISTS (SELECT 1 FROM events WHERE events.generation = %(gen)s AND events.id = incoming.id)
+            -- other archived events are not imported again
+            AND NOT EXISTS (SELECT 1 FROM events_archive WHERE events_archive.id = incoming.id)
+        """, { 'gen': generation })
+        counts['inserted'] = cur.rowcount
+        # a staged generation is published by switch()
+        if generation == current and (len(newrooms) > 0 or sum(counts.values()) > 0):
+            self.bumpversion(cur)
+        return counts
+
+    def retention(self):
+        """Return the retention window set in the config table, or None if archiving is disabled."""
+        days = self.setting('retention_days')
+        if days is None or days == '' or float(days) <= 0:
+            return None
+        return timedelta(days=float(days))
+    
+    def archive(self, now=None):
+        """
+        Move events that ended before the retention window into the archive table.
+        
+        This keeps the events table limited to current and future events. The
+        window is set by the retention_days key in the config table, nothing
+        is archived if it is not set. Archived events have already ended, so
+        the display is not affected and the data version is left alone.
+        Returns the number of archived events.
+        
+        Keyword arguments:
+        now -- the current time (default: datetime.now())
+        """
+        window = self.retention()
+        if window is None:
+            return 0
+        if now is None:
+            now = datetime.now()
+        def closure(cur, cutoff):
+            cur.execute("""
+                WITH moved AS (
+                    DELETE FROM events
+                    WHERE ends < %(cutoff)s
+                    AND generation = (SELECT CAST(value AS integer) FROM config WHERE key = 'generation')
+                    RETURNING id, room, begins, ends, name
+                )
+                INSERT INTO events_archive (id, room, begins, ends, name)
+                SELECT id, room, begins, ends, name FROM moved
+                WHERE NOT EXISTS (SELECT 1 FROM events_archive WHERE events_archive.id = moved.id)
+            """, { 'cutoff': cutoff })
+            return cur.rowcount
+        return self.execute(closure, now - window, label='archive')
 
     def dropall(self):
         """Delete all tables."""
         def closure(cur):
             cur.execute("""
+                DROP VIEW IF EXISTS current_events;
                 DROP TABLE IF EXISTS config;
                 DROP TABLE IF EXISTS slides;
                 DROP TABLE IF EXISTS events;
+                DROP TABLE IF EXISTS events_archive;
                 DROP TABLE IF EXISTS rooms;
+                DROP FUNCTION IF EXISTS infopage_notify();
             """)
         
-        self.execute(closure)
+        self.execute(closure, label='dropall')
     
     def insertdefault(self):
         """Insert default settings."""
@@ -325,9 +1280,10 @@ class Infopage (object):
                 INSERT INTO config (key, value) VALUES ('has_now', '1');
                 INSERT INTO config (key, value) VALUES ('now_text', 'Now');
                 INSERT INTO config (key, value) VALUES ('now_master_text', 'In session');
+                INSERT INTO config (key, value) VALUES ('data_version', '0');
             """)
         
-        self.execute(closure)
+        self.execute(closure, label='insertdefault')
     
     def createschema(self):
         """Create all the database tables if they don't exist yet."""
@@ -361,18 +1317,114 @@ class Infopage (object):
                     ends timestamp NOT NULL,
                     name text NOT NULL
                 );
+                -- Announce changes to listening clients, so they can drop their caches
+                CREATE OR REPLACE FUNCTION infopage_notify() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM pg_notify('infopage', TG_TABLE_NAME);
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+                DROP TRIGGER IF EXISTS config_notify ON config;
+                CREATE TRIGGER config_notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON config
+                    FOR EACH STATEMENT EXECUTE PROCEDURE infopage_notify();
             """)
         
-        self.execute(closure)
+        self.execute(closure, label='createschema')
 
-    def setting(self, key):
-        value = [ None ]
-        def closure(cur, key):
-            cur.execute("SELECT value FROM config WHERE key = %s", (key, ))
+    def schemaversion(self):
+        """Return the version of the last applied schema migration."""
+        def closure(cur):
+            cur.execute("SELECT value FROM config WHERE key = 'schema_version'")
             if cur.rowcount > 0:
-                value[0] = cur.fetchone()[0]
-        self.execute(closure, key)
-        return value[0]
+                return int(cur.fetchone()[0])
+            return 0
+        return self.execute(closure, label='schemaversion')
+    
+    def migrate(self):
+        """
+        Apply all pending schema migrations.
+        
+        The schema version is stored in the config table, so existing deployments
+        can be upgraded in place. createschema() must be called first.
+        Returns the list of migrations that were applied.
+        """
+        def closure(cur):
+            cur.execute("SELECT value FROM config WHERE key = 'schema_version' FOR UPDATE")
+            current = 0
+            if cur.rowcount > 0:
+                current = int(cur.fetchone()[0])
+            else:
+                cur.execute("INSERT INTO config (key, value) VALUES ('schema_version', '0')")
+            applied = [ ]
+            for version, statements in Infopage.MIGRATIONS:
+                if version > current:
+                    cur.execute(statements)
+                    cur.execute("UPDATE config SET value = %s WHERE key = 'schema_version'", (str(version), ))
+                    applied.append(version)
+            return applied
+        return self.execute(closure, label='migrate')
+    
+    def settings(self):
+        """
+        Return the contents of the config table as a dictionary.
+        
+        The table is loaded with a single query and cached for the whole process.
+        Cached settings expire after settingsttl seconds, or as soon as a change
+        notification for the config table is received.
+        The returned dictionary is shared and must not be modified.
+        """
+        self.pollnotifies()
+        key = self.connkey()
+        cached = Infopage.settingscache.get(key)
+        if cached is not None and time.time() - cached[0] < float(self.config['settingsttl']):
+            return cached[1]
+        def closure(cur):
+            cur.execute("SELECT key, value FROM config")
+            return dict(cur.fetchall())
+        loaded = time.time()
+        value = self.execute(closure, label='settings')
+        Infopage.settingscache[key] = (loaded, value)
+        return value
+
+    def setting(self, key):
+        """Return a single value from the config table, or None if it isn't set."""
+        return self.settings().get(key)
+
+    def setsetting(self, key, value):
+        """Store a single value in the config table, replacing any existing value."""
+        def closure(cur, key, value):
+            # TODO Upsert requires Postgres 9.5
+            cur.execute("UPDATE config SET value = %s WHERE key = %s", (value, key))
+            if cur.rowcount == 0:
+                cur.execute("INSERT INTO config (key, value) VALUES (%s, %s)", (key, value))
+        self.execute(closure, key, value, label='setsetting')
+        Infopage.settingscache.pop(self.connkey(), None)
+
+    def recordsync(self, counts, success=True):
+        """
+        Add the results of a sync to the counters in the config table.
+        
+        The counters are stored as sync_inserted, sync_updated, sync_deleted and
+        sync_conflicts, so they can be exported by a different process. The time
+        of the last successful sync is stored as sync_time (seconds since the epoch).
+        
+        Keyword arguments:
+        counts -- the counts returned by update(), and/or 'conflicts'
+        success -- also update the time of the last successful sync (default: True)
+        """
+        def closure(cur, counts, success):
+            values = [ ('sync_' + name, counts.get(name, 0)) for name in ('inserted', 'updated', 'deleted', 'conflicts') ]
+            for key, value in values:
+                # TODO Upsert requires Postgres 9.5
+                cur.execute("UPDATE config SET value = CAST(CAST(value AS integer) + %s AS text) WHERE key = %s", (value, key))
+                if cur.rowcount == 0:
+                    cur.execute("INSERT INTO config (key, value) VALUES (%s, %s)", (key, str(value)))
+            if success:
+                cur.execute("UPDATE config SET value = %s WHERE key = 'sync_time'", (str(int(time.time())), ))
+                if cur.rowcount == 0:
+                    cur.execute("INSERT INTO config (key, value) VALUES ('sync_time', %s)", (str(int(time.time())), ))
+        self.execute(closure, counts, success, label='recordsync')
+        Infopage.settingscache.pop(self.connkey(), None)
 
     def select(self, slidecounter):
         value = { 'slide': None, 'master': None, 'title': None }
@@ -380,15 +1432,15 @@ class Infopage (object):
             cur.execute("SELECT COUNT(sequence_no) FROM slides WHERE sequence_no IS NOT NULL")
             activeslides = cur.fetchone()[0]
             if activeslides > 0:
-                slideidx = abs(int(slidecounter)) % activeslides
+                slideidx = parsecounter(slidecounter) % activeslides
                 cur.execute("SELECT master, title FROM slides WHERE slides.sequence_no = %s", (slideidx, ))
                 if cur.rowcount > 0:
                     values = cur.fetchone()
                     value['master'] = values[0]
                     value['title'] = values[1]
                     value['slide'] = slideidx
-        if slidecounter is not None and slidecounter != '' and slidecounter > 0:
-            self.execute(closure)
+        if parsecounter(slidecounter) is not None:
+            self.execute(closure, label='select')
         return value
 
     def slide(self, slideno):
@@ -400,7 +1452,7 @@ class Infopage (object):
                 value['name'] = values[0]
                 value['room'] = values[1]
                 value['maxrows'] = values[2]
-        self.execute(closure, slideno)
+        self.execute(closure, slideno, label='slide')
         return value
 
     def events(self, time, limit, room = None, withnow = False):
@@ -408,21 +1460,737 @@ class Infopage (object):
         def closure(cur, time, limit, room, withnow):
             limitreal = int(limit)
             if room is None:
-                cur.execute("SELECT events.begins, events.ends, events.name, rooms.name FROM events JOIN rooms ON events.room = rooms.id WHERE events.begins <= %s AND events.ends >= %s ORDER BY begins LIMIT %s", (time, time, limitreal))
+                cur.execute("SELECT events.begins, events.ends, events.name, rooms.name FROM current_events AS events JOIN rooms ON events.room = rooms.id WHERE events.begins <= %s AND events.ends >= %s ORDER BY begins LIMIT %s", (time, time, limitreal))
                 if cur.rowcount > 0:
                     for row in cur.fetchall():
                         value['after'].append({ 'begins': row[0], 'ends': row[1], 'name': row[2], 'room': row[3] })
             else:
                 if withnow:
-                    cur.execute("SELECT begins, ends, name FROM events WHERE room = %s AND begins <= %s AND ends >= %s ORDER BY begins LIMIT 1", (room, time, time))
+                    cur.execute("SELECT begins, ends, name FROM current_events WHERE room = %s AND begins <= %s AND ends >= %s ORDER BY begins LIMIT 1", (room, time, time))
                     if cur.rowcount > 0:
                         now = cur.fetchone()
                         if now is not None:
                             limitreal -= 1
                             value['now'] = { 'begins': now[0], 'ends': now[1], 'name': now[2], 'room': None }
-                cur.execute("SELECT begins, ends, name FROM events WHERE room = %s AND begins >= %s ORDER BY begins LIMIT %s", (room, time, limitreal))
+                cur.execute("SELECT begins, ends, name FROM current_events WHERE room = %s AND begins >= %s ORDER BY begins LIMIT %s", (room, time, limitreal))
                 if cur.rowcount > 0:
                     for row in cur.fetchall():
                         value['after'].append({ 'begins': row[0], 'ends': row[1], 'name': row[2], 'room': None })
-        self.execute(closure, time, limit, room, withnow)
+        self.execute(closure, time, limit, room, withnow, label='events')
+        return value
+
+    def running(self, now, ahead=None):
+        """
+        Return True if any event is running at the given time.
+        
+        Keyword arguments:
+        now -- the time to check
+        ahead -- also consider events starting within this timedelta
+        """
+        until = now
+        if ahead is not None:
+            until = now + ahead
+        def closure(cur, now, until):
+            cur.execute("SELECT EXISTS (SELECT 1 FROM current_events WHERE ends >= %s AND begins <= %s)", (now, until))
+            return cur.fetchone()[0]
+        return self.execute(closure, now, until, label='running')
+
+    def playlist(self, now, until):
+        """
+        Return the active slides and all events running or starting before a deadline.
+        
+        Returns a dictionary in the following format:
+        {
+          'slides': [ { 'master': master_number, 'title': title, 'room': room_number, 'roomname': room_name, 'maxrows': max_rows }, ... ],
+          'events': [ { 'room': room_number, 'roomname': room_name, 'begins': begins, 'ends': ends, 'name': name }, ... ]
+        }
+        Slides are sorted by sequence number, events by start time.
+        
+        Keyword arguments:
+        now -- only return events ending at or after this time
+        until -- only return events starting before this time
+        """
+        value = { 'slides': [ ], 'events': [ ] }
+        def closure(cur, now, until):
+            cur.execute("""
+                SELECT slides.master, slides.title, slides.room, rooms.name, slides.max_rows
+                FROM slides LEFT JOIN rooms ON slides.room = rooms.id
+                WHERE slides.sequence_no IS NOT NULL
+                ORDER BY slides.sequence_no
+            """)
+            for row in cur.fetchall():
+                value['slides'].append({ 'master': row[0], 'title': row[1], 'room': row[2], 'roomname': row[3], 'maxrows': row[4] })
+            cur.execute("""
+                SELECT events.room, rooms.name, events.begins, events.ends, events.name
+                FROM current_events AS events JOIN rooms ON events.room = rooms.id
+                WHERE events.ends >= %s AND events.begins < %s
+                ORDER BY events.begins, events.id
+            """, (now, until))
+            for row in cur.fetchall():
+                value['events'].append({ 'room': row[0], 'roomname': row[1], 'begins': row[2], 'ends': row[3], 'name': row[4] })
+        self.execute(closure, now, until, label='playlist')
+        return value
+
+    def frame(self, slidecounter, now):
+        """
+        Fetch everything needed to render a slide in a single round-trip.
+        
+        This combines select(), slide(), settings() and events() into one query.
+        The "now" event and the following events of the slide's room are always
+        included, the events currently running in all rooms only if the slide
+        uses NOW_MASTER. Events starting at the same time are ordered by id.
+        
+        Returns a dictionary in the following format:
+        {
+          'selector': { 'slide': sequence_no, 'master': master_number, 'title': title },
+          'slide': { 'name': room_name, 'room': room_number, 'maxrows': max_rows },
+          'settings': { key: value, ... },
+          'events': {
+            'now': { 'begins': begins, 'ends': ends, 'name': name, 'room': None } or None,
+            'after': [ { 'begins': begins, 'ends': ends, 'name': name, 'room': None }, ... ],
+            'current': [ { 'begins': begins, 'ends': ends, 'name': name, 'room': room_name }, ... ]
+          }
+        }
+        
+        Keyword arguments:
+        slidecounter -- the slide counter sent by the client (see select())
+        now -- the current time
+        """
+        counter = parsecounter(slidecounter)
+        value = {
+            'selector': { 'slide': None, 'master': None, 'title': None },
+            'slide': { 'name': None, 'room': None, 'maxrows': None },
+            'settings': { },
+            'events': { 'now': None, 'after': [ ], 'current': [ ] },
+        }
+        def closure(cur, counter, now):
+            cur.execute("""
+                WITH active AS (
+                    SELECT COUNT(sequence_no) AS n FROM slides WHERE sequence_no IS NOT NULL
+                ), sel AS (
+                    SELECT slides.sequence_no, slides.master, slides.title, slides.room, slides.max_rows, rooms.name AS roomname
+                    FROM active, slides LEFT JOIN rooms ON slides.room = rooms.id
+                    WHERE active.n > 0 AND slides.sequence_no = %(counter)s %% active.n
+                ), lim AS (
+                    SELECT COALESCE((SELECT max_rows FROM sel), (SELECT CAST(value AS integer) FROM config WHERE key = 'max_rows')) AS n
+                ), nowev AS (
+                    SELECT begins, ends, name FROM current_events
+                    WHERE room = (SELECT room FROM sel) AND begins <= %(now)s AND ends >= %(now)s
+                    ORDER BY begins, id LIMIT 1
+                ), afterev AS (
+                    SELECT id, begins, ends, name FROM current_events
+                    WHERE room = (SELECT room FROM sel) AND begins >= %(now)s
+                    ORDER BY begins, id LIMIT (SELECT n FROM lim)
+                ), currentev AS (
+                    SELECT events.id, events.begins, events.ends, events.name, rooms.name AS roomname
+                    FROM current_events AS events JOIN rooms ON events.room = rooms.id
+                    WHERE (SELECT master FROM sel) = %(nowmaster)s AND events.begins <= %(now)s AND events.ends >= %(now)s
+                    ORDER BY events.begins, events.id LIMIT (SELECT n FROM lim)
+                )
+                SELECT
+                    sel.sequence_no, sel.master, sel.title, sel.room, sel.roomname, sel.max_rows,
+                    (SELECT array_agg(key) FROM config),
+                    (SELECT array_agg(value) FROM config),
+                    (SELECT begins FROM nowev), (SELECT ends FROM nowev), (SELECT name FROM nowev),
+                    (SELECT array_agg(begins ORDER BY begins, id) FROM afterev),
+                    (SELECT array_agg(ends ORDER BY begins, id) FROM afterev),
+                    (SELECT array_agg(name ORDER BY begins, id) FROM afterev),
+                    (SELECT array_agg(begins ORDER BY begins, id) FROM currentev),
+                    (SELECT array_agg(ends ORDER BY begins, id) FROM currentev),
+                    (SELECT array_agg(name ORDER BY begins, id) FROM currentev),
+                    (SELECT array_agg(roomname ORDER BY begins, id) FROM currentev)
+                FROM (SELECT 1) AS dummy LEFT JOIN sel ON true
+            """, { 'counter': counter, 'now': now, 'nowmaster': NOW_MASTER })
+            return cur.fetchone()
+        loaded = time.time()
+        row = self.execute(closure, counter, now, label='frame')
+        if row[0] is not None:
+            value['selector'] = { 'slide': row[0], 'master': row[1], 'title': row[2] }
+            if row[3] is not None:
+                value['slide'] = { 'name': row[4], 'room': row[3], 'maxrows': row[5] }
+        value['settings'] = dict(zip(row[6] or [ ], row[7] or [ ]))
+        Infopage.settingscache[self.connkey()] = (loaded, value['settings'])
+        if row[8] is not None:
+            value['events']['now'] = { 'begins': row[8], 'ends': row[9], 'name': row[10], 'room': None }
+        for begins, ends, name in zip(row[11] or [ ], row[12] or [ ], row[13] or [ ]):
+            value['events']['after'].append({ 'begins': begins, 'ends': ends, 'name': name, 'room': None })
+        for begins, ends, name, room in zip(row[14] or [ ], row[15] or [ ], row[16] or [ ], row[17] or [ ]):
+            value['events']['current'].append({ 'begins': begins, 'ends': ends, 'name': name, 'room': room })
+        return value
+
+    def loadindex(self):
+        """
+        Return the active slides and an EventIndex of all current and future events.
+        
+        Both are loaded once per data version and shared by the whole process.
+        Returns a tuple (slides keyed by sequence number, EventIndex).
+        """
+        key = (self.connkey(), self.dataversion())
+        value = Infopage.indexes.get(key)
+        if value is None:
+            def closure(cur, now):
+                cur.execute("""
+                    SELECT slides.sequence_no, slides.master, slides.title, slides.room, rooms.name, slides.max_rows
+                    FROM slides LEFT JOIN rooms ON slides.room = rooms.id
+                    WHERE slides.sequence_no IS NOT NULL
+                """)
+                slides = { }
+                for row in cur.fetchall():
+                    slides[row[0]] = { 'master': row[1], 'title': row[2], 'room': row[3], 'roomname': row[4], 'maxrows': row[5] }
+                # events that have already ended can never be returned again
+                cur.execute("""
+                    SELECT events.id, events.room, rooms.name, events.begins, events.ends, events.name
+                    FROM current_events AS events JOIN rooms ON events.room = rooms.id
+                    WHERE events.ends >= %s
+                """, (now, ))
+                events = [ { 'id': row[0], 'room': row[1], 'roomname': row[2], 'begins': row[3], 'ends': row[4], 'name': row[5] } for row in cur.fetchall() ]
+                return (slides, EventIndex(events))
+            value = self.execute(closure, datetime.now(), label='loadindex')
+            Infopage.indexes.put(key, value)
         return value
+
+    def indexedframe(self, slidecounter, now):
+        """
+        Same as frame(), but answered from the in-memory event index.
+        Only needs a database query when the data version has changed.
+        """
+        slides, index = self.loadindex()
+        return buildframe(self.settings(), slides, index, slidecounter, now)
+
+    def export(self, path):
+        """
+        Write the config, rooms, slides and events tables into an SQLite file.
+        
+        The tables are read in a single transaction, so the copy is consistent.
+        The file is written under a temporary name and renamed into place,
+        so readers always see either the old or the new snapshot.
+        
+        Keyword arguments:
+        path -- the name of the snapshot file
+        """
+        def closure(cur):
+            cur.execute(self.EXPORT_TRANSACTION)
+            tables = { }
+            cur.execute("SELECT key, value FROM config")
+            tables['config'] = cur.fetchall()
+            cur.execute("SELECT id, name FROM rooms")
+            tables['rooms'] = cur.fetchall()
+            cur.execute("SELECT id, sequence_no, room, master, title, max_rows FROM slides")
+            tables['slides'] = cur.fetchall()
+            cur.execute("SELECT id, room, begins, ends, name FROM current_events")
+            tables['events'] = cur.fetchall()
+            return tables
+        tables = self.execute(closure, label='export')
+        temp = path + '.tmp'
+        if os.path.exists(temp):
+            os.remove(temp)
+        snapshot = sqlite3.connect(temp)
+        try:
+            snapshot.executescript(SQLITE_SCHEMA)
+            snapshot.executemany("INSERT INTO config (key, value) VALUES (?, ?)", tables['config'])
+            snapshot.executemany("INSERT INTO rooms (id, name) VALUES (?, ?)", tables['rooms'])
+            snapshot.executemany("INSERT INTO slides (id, sequence_no, room, master, title, max_rows) VALUES (?, ?, ?, ?, ?, ?)", tables['slides'])
+            snapshot.executemany("INSERT INTO events (id, room, begins, ends, name) VALUES (?, ?, ?, ?, ?)", tables['events'])
+            snapshot.commit()
+        finally:
+            snapshot.close()
+        os.rename(temp, path)
+    
+    def publish(self, changed=True):
+        """
+        Export a snapshot if a snapshot file is configured.
+        Writers should call this after each successful change.
+        
+        Keyword arguments:
+        changed -- if not set, only export if there is no snapshot yet (default: True)
+        """
+        path = self.config.get('snapshot')
+        if path and (changed or not os.path.exists(path)):
+            self.export(path)
+
+class SqliteCursor(object):
+    """
+    Adapts an sqlite3 cursor to the statement closures written for psycopg2.
+    
+    Parameters are accepted in the psycopg2 style (%s and %(name)s), strings
+    without parameters may contain several statements, and rowcount is also
+    set for queries, whose results are fetched immediately.
+    """
+    PARAMETER = re.compile(r"%\((\w+)\)s|%s|%%")
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.rows = [ ]
+        self.rowcount = -1
+    @staticmethod
+    def translate(sql):
+        """Convert psycopg2 placeholders into sqlite3 placeholders."""
+        def replace(match):
+            if match.group(1) is not None:
+                return ':' + match.group(1)
+            if match.group(0) == '%s':
+                return '?'
+            return '%'
+        return SqliteCursor.PARAMETER.sub(replace, sql)
+    @staticmethod
+    def split(sql):
+        """Split a string into complete SQL statements."""
+        statements = [ ]
+        buffer = ''
+        for part in sql.split(';'):
+            buffer += part + ';'
+            if sqlite3.complete_statement(buffer):
+                statements.append(buffer)
+                buffer = ''
+        return statements
+    def execute(self, sql, params=None):
+        # like psycopg2, placeholders are only interpreted if there are parameters
+        if params is None:
+            for statement in SqliteCursor.split(sql):
+                self.cursor.execute(statement)
+        else:
+            self.cursor.execute(SqliteCursor.translate(sql), params)
+        self.fetch()
+    def executemany(self, sql, params):
+        self.cursor.executemany(SqliteCursor.translate(sql), params)
+        self.fetch()
+    def fetch(self):
+        if self.cursor.description is not None:
+            self.rows = self.cursor.fetchall()
+            self.rowcount = len(self.rows)
+        else:
+            self.rows = [ ]
+            self.rowcount = self.cursor.rowcount
+    def fetchone(self):
+        if len(self.rows) == 0:
+            return None
+        return self.rows.pop(0)
+    def fetchall(self):
+        rows = self.rows
+        self.rows = [ ]
+        return rows
+    def close(self):
+        self.cursor.close()
+
+class SqliteInfopage(Infopage):
+    """
+    infopage database access on an embedded SQLite database
+    
+    Implements the same API as Infopage without a database server, for small
+    installations. The database file is set with the dbfile setting. Use
+    database() to create the access object for the configured backend.
+    
+    There are no change notifications, listen() and wait() watch the
+    database file instead. Locks are taken on files next to the database.
+    """
+    
+    EXPORT_TRANSACTION = "BEGIN"
+    # how often wait() looks for changes (seconds)
+    POLL_INTERVAL = 1
+    # state of each database file when it was last checked, keyed by connection parameters
+    filestates = { }
+    
+    def __init__(self, configfile=None, pooled=False):
+        """
+        Create a new infopage database access object.
+        Connections are cheap, so pooled mode opens a new one on every connect() as well.
+        """
+        Infopage.__init__(self, configfile, pooled)
+        # lock files held by trylock(), keyed by lock key
+        self.locks = { }
+        self.listened = None
+    
+    def connkey(self):
+        """Return a key identifying the database of the current settings."""
+        return ('sqlite', self.config['dbfile'])
+    
+    def connect(self):
+        """Open the database file."""
+        self.broken = False
+        # writers hold the database lock for the duration of a sync, wait for them
+        self.conn = sqlite3.connect(self.config['dbfile'], timeout=30, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+    def close(self):
+        """Close the database file and release all locks."""
+        for key in list(self.locks):
+            self.unlock(key)
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+    
+    def transaction(self, closure, *args, **kwargs):
+        """Run a statement closure in a transaction, see execute()."""
+        with self.conn:
+            cur = SqliteCursor(self.conn.cursor())
+            try:
+                return closure(cur, *args, **kwargs)
+            finally:
+                cur.close()
+    
+    def filestate(self):
+        """Return a value that changes whenever a transaction is committed to the database."""
+        state = [ ]
+        # in WAL mode, commits only modify the log
+        for name in (self.config['dbfile'], self.config['dbfile'] + '-wal'):
+            try:
+                st = os.stat(name)
+                state.append((st.st_mtime, st.st_size))
+            except OSError:
+                state.append(None)
+        return tuple(state)
+    
+    def listen(self):
+        """Start watching the database file for changes, see wait()."""
+        self.listened = self.filestate()
+    
+    def pollnotifies(self):
+        """
+        Check if the database has changed since the last call, in any thread.
+        Cached settings are dropped if it has.
+        """
+        state = self.filestate()
+        key = self.connkey()
+        if SqliteInfopage.filestates.get(key) == state:
+            return set()
+        SqliteInfopage.filestates[key] = state
+        Infopage.settingscache.pop(key, None)
+        return set([ 'config', 'rooms', 'slides', 'events' ])
+    
+    def wait(self, timeout):
+        """
+        Wait for changes to the database file.
+        
+        listen() must have been called first. Returns the set of table names that
+        may have changed, or an empty set if the timeout expired.
+        
+        Keyword arguments:
+        timeout -- the maximum time to wait (seconds)
+        """
+        deadline = time.time() + timeout
+        while True:
+            state = self.filestate()
+            if state != self.listened:
+                self.listened = state
+                Infopage.settingscache.pop(self.connkey(), None)
+                return set([ 'config', 'rooms', 'slides', 'events' ])
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return set()
+            time.sleep(min(SqliteInfopage.POLL_INTERVAL, remaining))
+    
+    def trylock(self, key):
+        """
+        Try to take an exclusive lock on a file next to the database.
+        
+        Returns True if the lock was acquired. The lock is held until unlock()
+        is called or the database is closed.
+        """
+        if key in self.locks:
+            return True
+        fh = open('{0}.lock-{1:x}'.format(self.config['dbfile'], key), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                fh.close()
+                return False
+        self.locks[key] = fh
+        return True
+    
+    def unlock(self, key):
+        """Release a lock taken with trylock()."""
+        fh = self.locks.pop(key, None)
+        if fh is not None:
+            # closing the file releases the lock
+            fh.close()
+    
+    def dropall(self):
+        """Delete all tables."""
+        def closure(cur):
+            cur.execute("""
+                DROP VIEW IF EXISTS current_events;
+                DROP TABLE IF EXISTS events;
+                DROP TABLE IF EXISTS events_archive;
+                DROP TABLE IF EXISTS slides;
+                DROP TABLE IF EXISTS rooms;
+                DROP TABLE IF EXISTS config;
+            """)
+        self.execute(closure, label='dropall')
+    
+    def createschema(self):
+        """Create all the database tables if they don't exist yet."""
+        def closure(cur):
+            cur.execute(SQLITE_SCHEMA)
+        self.execute(closure, label='createschema')
+        # let the display read while a sync is writing
+        self.conn.execute("PRAGMA journal_mode = WAL")
+    
+    def migrate(self):
+        """Same as Infopage.migrate()."""
+        def closure(cur):
+            cur.execute("SELECT value FROM config WHERE key = 'schema_version'")
+            current = 0
+            if cur.rowcount > 0:
+                current = int(cur.fetchone()[0])
+            else:
+                cur.execute("INSERT INTO config (key, value) VALUES ('schema_version', '0')")
+            applied = [ ]
+            for version, statements in Infopage.MIGRATIONS:
+                if version > current:
+                    cur.execute(statements)
+                    cur.execute("UPDATE config SET value = %s WHERE key = 'schema_version'", (str(version), ))
+                    applied.append(version)
+            return applied
+        return self.execute(closure, label='migrate')
+    
+    def bulkupdate(self, cur, events, prune=False, generation=None, cutoff=None):
+        """
+        Statement closure for the batched path of update().
+        There are no round-trips to save, so the stored events are compared in memory.
+        """
+        current = self.currentgeneration(cur)
+        if generation is None:
+            generation = current
+        cur.execute("SELECT id, name FROM rooms")
+        rooms = dict(cur.fetchall())
+        cur.execute("SELECT id, room, begins, ends, name FROM events WHERE generation = %s", (generation, ))
+        stored = dict([ (row[0], tuple(row[1:])) for row in cur.fetchall() ])
+        newrooms = [ ]
+        # if an event occurs more than once, the last occurrence wins
+        incoming = { }
+        for e in events:
+            eid = e['id'].int & 0x7fffffff
+            rid = e['venue_id'] & 0x7fffffff
+            rname = rooms.get(rid)
+            if rname is None:
+                rooms[rid] = e['venue']
+                newrooms.append((rid, e['venue']))
+            elif rname != e['venue']:
+                # TODO Implement UPDATE if appropriate
+                raise ConflictError("Room exists, but ID and name don't match")
+            incoming[eid] = (bool(e['active']), (rid, e['start_time'], e['end_time'], e['name']))
+        if prune:
+            deleted = [ (generation, eid) for eid in stored if eid not in incoming or not incoming[eid][0] ]
+        else:
+            deleted = [ (generation, eid) for eid, (active, row) in incoming.items() if not active and eid in stored ]
+        updated = [ row + (generation, eid) for eid, (active, row) in incoming.items() if active and eid in stored and stored[eid] != row ]
+        inserted = [ (generation, eid) + row for eid, (active, row) in incoming.items() if active and eid not in stored ]
+        cur.execute("SELECT id FROM events_archive")
+        archived = set([ row[0] for row in cur.fetchall() ])
+        # archived events leave the archive if they have been deleted or moved into the retention window
+        restored = [ (eid, ) for eid, (active, row) in incoming.items() if eid in archived and (not active or cutoff is None or row[2] >= cutoff) ]
+        if len(restored) > 0:
+            cur.executemany("DELETE FROM events_archive WHERE id = %s", restored)
+            archived.difference_update([ eid for eid, in restored ])
+        # other archived events are not imported again
+        inserted = [ row for row in inserted if row[1] not in archived ]
+        if len(newrooms) > 0:
+            cur.executemany("INSERT INTO rooms (id, name) VALUES (%s, %s)", newrooms)
+        if len(deleted) > 0:
+            cur.executemany("DELETE FROM events WHERE generation = %s AND id = %s", deleted)
+        if len(updated) > 0:
+            cur.executemany("UPDATE events SET room = %s, begins = %s, ends = %s, name = %s WHERE generation = %s AND id = %s", updated)
+        if len(inserted) > 0:
+            cur.executemany("INSERT INTO events (generation, id, room, begins, ends, name) VALUES (%s, %s, %s, %s, %s, %s)", inserted)
+        counts = { 'inserted': len(inserted), 'updated': len(updated), 'deleted': len(deleted) }
+        # a staged generation is published by switch()
+        if generation == current and (len(newrooms) > 0 or sum(counts.values()) > 0):
+            self.bumpversion(cur)
+        return counts
+    
+    def archive(self, now=None):
+        """Same as Infopage.archive()."""
+        window = self.retention()
+        if window is None:
+            return 0
+        if now is None:
+            now = datetime.now()
+        def closure(cur, cutoff):
+            cur.execute("""
+                INSERT INTO events_archive (id, room, begins, ends, name)
+                SELECT id, room, begins, ends, name FROM current_events
+                WHERE ends < %(cutoff)s
+                AND NOT EXISTS (SELECT 1 FROM events_archive WHERE events_archive.id = current_events.id)
+            """, { 'cutoff': cutoff })
+            archived = cur.rowcount
+            cur.execute("""
+                DELETE FROM events
+                WHERE ends < %(cutoff)s
+                AND generation = (SELECT CAST(value AS integer) FROM config WHERE key = 'generation')
+            """, { 'cutoff': cutoff })
+            return archived
+        return self.execute(closure, now - window, label='archive')
+    
+    def frame(self, slidecounter, now):
+        """
+        Same as Infopage.frame().
+        Answered from the in-memory event index, which is cheaper than several queries.
+        """
+        return self.indexedframe(slidecounter, now)
+
+class Snapshot(object):
+    """
+    Read-only access to a snapshot file written by Infopage.export()
+    
+    Implements the part of the Infopage API that is needed to display slides,
+    without a database server. The file is loaded into memory once and
+    reloaded when it has been replaced, queries are answered from an EventIndex.
+    
+    Example usage:
+    
+    snapshot = Snapshot('/var/lib/infopage/snapshot.db')
+    with snapshot:
+        frame = snapshot.frame(slidecounter, datetime.now())
+    """
+    
+    # process-wide cache of loaded snapshots, keyed by file name
+    # each entry is a tuple (file identity, data)
+    loaded = { }
+    lock = threading.Lock()
+    # how often wait() looks for a new file (seconds)
+    POLL_INTERVAL = 1
+    
+    def __init__(self, path, config=None):
+        """
+        Create a new snapshot reader.
+        
+        Keyword arguments:
+        path -- the name of the snapshot file
+        config -- a configuration dictionary, as used by Infopage (default: empty)
+        """
+        self.path = path
+        self.config = config or { }
+        self.data = None
+        self.version = None
+        # snapshots are answered from memory, see Infopage.queries
+        self.queries = 0
+    
+    def __enter__(self):
+        self.connect()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def connect(self):
+        """Load the current snapshot, if it has changed since it was last loaded."""
+        self.version, self.data = self.load()
+    def close(self):
+        self.version = None
+        self.data = None
+    def listen(self):
+        pass
+    
+    def identity(self):
+        """Return a value that changes whenever the snapshot file is replaced."""
+        st = os.stat(self.path)
+        return (st.st_ino, st.st_mtime, st.st_size)
+    
+    def load(self):
+        """
+        Return the contents of the snapshot file, reading it only if it was replaced.
+        Returns a tuple (file identity, data).
+        """
+        identity = self.identity()
+        with Snapshot.lock:
+            cached = Snapshot.loaded.get(self.path)
+            if cached is not None and cached[0] == identity:
+                return cached
+        snapshot = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES)
+        try:
+            settings = dict(snapshot.execute("SELECT key, value FROM config"))
+            slides = { }
+            for row in snapshot.execute("""
+                SELECT slides.sequence_no, slides.master, slides.title, slides.room, rooms.name, slides.max_rows
+                FROM slides LEFT JOIN rooms ON slides.room = rooms.id
+                WHERE slides.sequence_no IS NOT NULL
+            """):
+                slides[row[0]] = { 'master': row[1], 'title': row[2], 'room': row[3], 'roomname': row[4], 'maxrows': row[5] }
+            # events that have already ended can never be returned again
+            events = [ { 'id': row[0], 'room': row[1], 'roomname': row[2], 'begins': row[3], 'ends': row[4], 'name': row[5] } for row in snapshot.execute("""
+                SELECT events.id, events.room, rooms.name, events.begins, events.ends, events.name
+                FROM events JOIN rooms ON events.room = rooms.id
+                WHERE events.ends >= ?
+            """, (datetime.now(), )) ]
+        finally:
+            snapshot.close()
+        data = { 'settings': settings, 'slides': slides, 'index': EventIndex(events) }
+        with Snapshot.lock:
+            Snapshot.loaded[self.path] = (identity, data)
+        return (identity, data)
+    
+    def wait(self, timeout):
+        """
+        Wait until the snapshot file is replaced.
+        
+        Returns the set of table names that may have changed, or an empty set
+        if the timeout expired.
+        
+        Keyword arguments:
+        timeout -- the maximum time to wait (seconds)
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                if self.identity() != self.version:
+                    self.connect()
+                    return set([ 'config', 'rooms', 'slides', 'events' ])
+            except OSError:
+                # the file is being replaced
+                pass
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return set()
+            time.sleep(min(Snapshot.POLL_INTERVAL, remaining))
+    
+    def getconfig(self, key):
+        """Get a value from the configuration dictionary."""
+        return self.config.get(key)
+    
+    def settings(self):
+        """Return the config table of the snapshot as a dictionary."""
+        return self.data['settings']
+    
+    def setting(self, key):
+        """Return a single value from the config table, or None if it isn't set."""
+        return self.settings().get(key)
+    
+    def dataversion(self):
+        """Return the data version of the snapshot."""
+        return int(self.settings().get('data_version') or 0)
+    
+    def activeslides(self):
+        """Return the number of slides with a sequence number."""
+        return len(self.data['slides'])
+    
+    def playlist(self, now, until):
+        """Same as Infopage.playlist()."""
+        slides = [ self.data['slides'][n] for n in sorted(self.data['slides']) ]
+        index = self.data['index']
+        last = bisect.bisect_left(index.begins, until)
+        events = [ { 'room': e['room'], 'roomname': e['roomname'], 'begins': e['begins'], 'ends': e['ends'], 'name': e['name'] } for e in index.events[:last] if e['ends'] >= now ]
+        return { 'slides': [ dict(s) for s in slides ], 'events': events }
+    
+    def frame(self, slidecounter, now):
+        """Same as Infopage.frame()."""
+        return buildframe(self.settings(), self.data['slides'], self.data['index'], slidecounter, now)
+    
+    indexedframe = frame
+
+def database(configfile=None, pooled=False, cached=False):
+    """
+    Create a database access object for the configured backend.
+    
+    Loads the configuration like Infopage.loadconfig() and returns
+    a SqliteInfopage if the backend setting is sqlite, or an Infopage otherwise.
+    
+    Keyword arguments:
+    configfile -- the name of the file to load (default: /etc/infopage.conf)
+    pooled -- take connections from a process-wide pool (default: False)
+    cached -- use the process-wide config cache (default: False)
+    """
+    db = Infopage(pooled=pooled)
+    db.loadconfig(configfile, cached)
+    if db.config['backend'] == 'sqlite':
+        sqlite = SqliteInfopage(pooled=pooled)
+        sqlite.config = db.config
+        return sqlite
+    return db
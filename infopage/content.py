@@ -1,12 +1,62 @@
 # coding: utf-8
 
-from datetime import datetime
+import sys
+import json
+import time
+import threading
+from email.utils import formatdate
+from datetime import datetime, timedelta
 from string import Template
-import psycopg2
-from infopage import Infopage
+import infopage
+from infopage import Infopage, Snapshot, LRUCache
+try:
+	from mod_python import apache
+except ImportError:
+	# not running inside mod_python
+	apache = None
+try:
+	from html import escape
+except ImportError:
+	from cgi import escape
+
+class CompiledTemplate(object):
+    """
+    A string.Template that is parsed only once.
+    
+    The template is split into literal text and placeholders, so rendering
+    is a single list join. Values are HTML-escaped, except for the
+    placeholders listed in raw, which must already contain valid markup.
+    """
+    def __init__(self, template, raw=()):
+        self.parts = [ ]
+        literal = [ ]
+        position = 0
+        for match in Template.pattern.finditer(template):
+            literal.append(template[position:match.start()])
+            position = match.end()
+            if match.group('escaped') is not None:
+                literal.append(Template.delimiter)
+            elif match.group('invalid') is not None:
+                raise ValueError("Invalid placeholder in template at position {0}".format(match.start()))
+            else:
+                name = match.group('named') or match.group('braced')
+                self.parts.append((u''.join(literal), name, name not in raw))
+                literal = [ ]
+        literal.append(template[position:])
+        self.tail = u''.join(literal)
+    def render(self, **values):
+        out = [ ]
+        for literal, name, escaped in self.parts:
+            out.append(literal)
+            if escaped:
+                out.append(escape(u'%s' % values[name], True))
+            else:
+                out.append(values[name])
+        out.append(self.tail)
+        return u''.join(out)
 
 class Master(object):
-    pagetemplate = Template('''
+    pagetemplate = CompiledTemplate(u'''
             <div id="titlepane">
                 <table>
                     <tr>
@@ -19,77 +69,396 @@ class Master(object):
             <div id="contentpane">
                 <table>$content</table>
             </div>
-    ''')
-    rowtemplate = Template('''
+    ''', raw=('content', ))
+    rowtemplate = CompiledTemplate(u'''
                     <tr>
                         <td class="desc"><div class="cell">$description</div></td>
                         <td class="time">$start</td>
                     </tr>
     ''')
+    # rendered rows, keyed by the values they depend on
+    rowcache = LRUCache(1024)
     def __init__(self):
         pass
-    def generate(self, db, slideno):
+    def generate(self, frame, now):
         pass
+    def row(self, key, **values):
+        """Render a row, or return a copy that was rendered from the same key before."""
+        fragment = self.rowcache.get(key)
+        if fragment is None:
+            fragment = self.rowtemplate.render(**values)
+            self.rowcache.put(key, fragment)
+        return fragment
 
 class EventMaster(Master):
     def __init__(self, hasnow):
         self.hasnow = hasnow
-    def generate(self, db, slideno, title):
-        timeformat = db.setting('time_format')
-        nowtemplate = db.setting('now_text')
-        maxrows = db.setting('max_rows')
-        now = datetime.now()
-        content = ""
-        slidedef = db.slide(slideno)
+    def generate(self, frame, now):
+        settings = frame['settings']
+        timeformat = settings.get('time_format')
+        nowtemplate = settings.get('now_text')
+        maxrows = settings.get('max_rows')
+        title = frame['selector']['title']
+        rows = [ ]
+        slidedef = frame['slide']
         if slidedef['name'] is not None:
             title = slidedef['name']
         if slidedef['maxrows'] is not None:
-            maxrows = int(slidedef['maxrows'])
+            maxrows = slidedef['maxrows']
         if slidedef['room'] is not None:
-            events = db.events(now, maxrows, slidedef['room'], self.hasnow)
-            if events['now'] is not None:
-                content += self.rowtemplate.substitute(description=events['now']['name'], start=nowtemplate)
-            for event in events['after']:
-                beginformat = event['begins'].strftime(timeformat)
-                content += self.rowtemplate.substitute(description=event['name'], start=beginformat)
+            maxrows = int(maxrows)
+            events = frame['events']
+            if self.hasnow and events['now'] is not None:
+                name = events['now']['name']
+                rows.append(self.row((name, None, nowtemplate), description=name, start=nowtemplate))
+                maxrows -= 1
+            for event in events['after'][:maxrows]:
+                key = (event['name'], event['begins'], timeformat)
+                fragment = self.rowcache.get(key)
+                if fragment is None:
+                    # formatting the start time is only needed for rows that aren't cached yet
+                    fragment = self.rowtemplate.render(description=event['name'], start=event['begins'].strftime(timeformat))
+                    self.rowcache.put(key, fragment)
+                rows.append(fragment)
         nowformat = now.strftime(timeformat)
-        return self.pagetemplate.substitute(title=title, time=nowformat, content=content)
+        return self.pagetemplate.render(title=title, time=nowformat, content=u''.join(rows))
 
 class NowMaster(Master):
-    rowtemplate = Template('''
+    rowtemplate = CompiledTemplate(u'''
                     <tr>
                         <td class="nowdesc"><div class="cell">$description</div></td>
                         <td class="room"><div class="$style">$start</div></td>
                     </tr>
     ''')
+    rowcache = LRUCache(1024)
     def __init__(self):
         pass
-    def generate(self, db, slideno, title):
-        timeformat = db.setting('time_format')
-        nowtemplate = db.setting('now_master_text')
-        maxrows = db.setting('max_rows')
-        now = datetime.now()
-        content = ""
+    def generate(self, frame, now):
+        settings = frame['settings']
+        timeformat = settings.get('time_format')
+        nowtemplate = settings.get('now_master_text')
+        title = frame['selector']['title']
+        rows = [ ]
         if title is None:
             title = nowtemplate
-        events = db.events(now, maxrows)
-        for event in events['after']:
+        for event in frame['events']['current']:
             if len(event['name']) > 14:
-                content += self.rowtemplate.substitute(style="roomlong", description=event['name'], start=event['room'])
+                style = "roomlong"
             else:
-                content += self.rowtemplate.substitute(style="room", description=event['name'], start=event['room'])
+                style = "room"
+            rows.append(self.row((event['name'], event['room']), style=style, description=event['name'], start=event['room']))
         nowformat = now.strftime(timeformat)
-        return self.pagetemplate.substitute(title=title, time=nowformat, content=content)
+        return self.pagetemplate.render(title=title, time=nowformat, content=u''.join(rows))
 
 masters = [ EventMaster(True), EventMaster(False), NowMaster(), ]
 
+# mod_python.publisher exposes every public name in this module,
+# so helpers and module state are prefixed with an underscore.
+
+# rendered slides, keyed by (sequence number, minute, data version)
+_rendered = LRUCache(64)
+
+# serialized playlists, keyed by (date, data version)
+_playlists = LRUCache(4)
+
+# push streams are closed after this many seconds, the browser reconnects automatically
+_PUSH_DURATION = 300
+
+# sync counters stored by Infopage.recordsync(), with their descriptions
+_SYNC_COUNTERS = [
+	('inserted', "Events inserted by the syncer"),
+	('updated', "Events updated by the syncer"),
+	('deleted', "Events deleted by the syncer"),
+	('conflicts', "Syncs aborted because of a room conflict"),
+]
+
+Infopage.metrics.describe('infopage_slide_seconds', 'histogram', "Duration of slide requests, by result (notmodified, cached or rendered)")
+Infopage.metrics.describe('infopage_slide_queries', 'histogram', "Database transactions per slide request", (0, 1, 2, 3, 5, 10))
+
+def _database(pooled=True):
+	"""
+	Return the data source for the display.
+	
+	This is the read-only snapshot if a snapshot file is configured,
+	so no database connection is needed at all, and the database otherwise.
+	"""
+	db = infopage.database(pooled=pooled, cached=True)
+	if db.config.get('snapshot'):
+		return Snapshot(db.config['snapshot'], db.config)
+	return db
+
+def _slideindex(db, counter):
+	"""Map a parsed slide counter to a sequence number, using only cached data if possible."""
+	if counter is None:
+		return None
+	count = db.activeslides()
+	if count > 0:
+		return counter % count
+	return None
+
+def _validators(key):
+	"""Return the caching headers for a rendered slide key (sequence number, minute, data version)."""
+	index, minute, version = key
+	return {
+		'ETag': '"v{version}-s{index}-m{minute}"'.format(version=version, index=index, minute=minute.strftime('%Y%m%d%H%M')),
+		'Last-Modified': formatdate(time.mktime(minute.timetuple()), usegmt=True),
+		# caches may keep a copy, but must revalidate it on every request
+		'Cache-Control': 'no-cache',
+	}
+
+def _etags(header):
+	"""Parse an If-None-Match header into a list of entity tags."""
+	if header is None:
+		return [ ]
+	tags = [ ]
+	for tag in header.split(','):
+		tag = tag.strip()
+		if tag.startswith('W/'):
+			tag = tag[2:]
+		tags.append(tag)
+	return tags
+
+def _render(frame, now):
+	"""Render a frame with its master, or return None if the master doesn't exist."""
+	master = frame['selector']['master']
+	if master is None:
+		master = 0
+	if master < len(masters):
+		return masters[master].generate(frame, now)
+	return None
+
+def _measure(db, start, result):
+	"""Record the duration and number of transactions of a slide request, if metrics are enabled."""
+	if db.getconfig('metrics'):
+		Infopage.metrics.observe('infopage_slide_seconds', (('result', result), ), time.time() - start)
+		Infopage.metrics.observe('infopage_slide_queries', (), db.queries)
+
+def _slide(slide, etags):
+	"""
+	Render a slide, unless the client already has an up-to-date copy.
+	
+	Validation only uses cached data, so a matching entity tag will normally
+	be answered without a database query.
+	Returns a tuple (HTTP status, response headers, body).
+	"""
+	start = time.time()
+	# query parameters are strings, the rest of the code expects a number
+	counter = infopage.parsecounter(slide)
+	db = _database()
+	now = datetime.now()
+	minute = now.replace(second=0, microsecond=0)
+	with db:
+		key = (_slideindex(db, counter), minute, db.dataversion())
+		headers = _validators(key)
+		if headers['ETag'] in etags:
+			_measure(db, start, 'notmodified')
+			return (304, headers, '')
+		page = _rendered.get(key)
+		if page is not None:
+			_measure(db, start, 'cached')
+			return (200, headers, page)
+		if db.getconfig('eventindex'):
+			frame = db.indexedframe(counter, now)
+		else:
+			frame = db.frame(counter, now)
+	page = _render(frame, now)
+	_measure(db, start, 'rendered')
+	if page is not None:
+		version = int(frame['settings'].get('data_version') or 0)
+		key = (frame['selector']['slide'], minute, version)
+		_rendered.put(key, page)
+		return (200, _validators(key), page)
+	return (200, headers, None)
+
 def slide(req, slide):
-    db = Infopage()
-    db.loadconfig()
-    with db:
-		selector = db.select(slide)
-		if selector['master'] is None:
-			selector['master'] = 0
-		if selector['master'] < len(masters):
-			master = masters[selector['master']]
-			return master.generate(db, selector['slide'], selector['title'])
+	status, headers, page = _slide(slide, _etags(req.headers_in.get('If-None-Match')))
+	for name, value in headers.items():
+		req.headers_out[name] = value
+	if status == 304:
+		raise apache.SERVER_RETURN(apache.HTTP_NOT_MODIFIED)
+	return page
+
+def _jsontime(value):
+	"""Serialize timestamps as local ISO 8601 strings."""
+	if isinstance(value, datetime):
+		return value.strftime('%Y-%m-%dT%H:%M:%S')
+	raise TypeError(repr(value) + " is not JSON serializable")
+
+def _playlist():
+	"""Return the serialized playlist of the current day."""
+	db = _database()
+	now = datetime.now()
+	with db:
+		key = (now.date(), db.dataversion())
+		data = _playlists.get(key)
+		if data is None:
+			settings = db.settings()
+			midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+			value = db.playlist(now, midnight)
+			value['version'] = key[1]
+			value['date'] = now.strftime('%Y-%m-%d')
+			value['settings'] = dict([ (name, settings.get(name)) for name in ('time_format', 'max_rows', 'now_text', 'now_master_text') ])
+			data = json.dumps(value, default=_jsontime)
+			_playlists.put(key, data)
+	return data
+
+def playlist(req):
+	"""
+	The slide order and all remaining events of the day as JSON,
+	for displays that render slides on their own (see playlist.html).
+	"""
+	req.content_type = 'application/json'
+	return _playlist()
+
+def _pushstate(db, now):
+	"""Return the state that displays need to know about to keep their local copies valid."""
+	return {
+		'version': db.dataversion(),
+		'slides': db.activeslides(),
+		'minute': now.strftime('%Y-%m-%d %H:%M'),
+	}
+
+class _PushHub(object):
+    """
+    Watches the data source on behalf of all push streams of this process.
+    
+    A single background thread holds the only dedicated connection. It waits
+    for change notifications and for the start of every minute, and wakes up
+    the streams when the state has changed. The thread exits once the last
+    stream is gone.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.state = None
+        self.streams = 0
+        self.thread = None
+    def available(self, limit):
+        """Return True if another stream may be opened."""
+        with self.condition:
+            return self.streams < limit
+    def subscribe(self):
+        """Register a stream and start the watcher thread if necessary."""
+        with self.condition:
+            self.streams += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='infopage-push')
+                self.thread.daemon = True
+                self.thread.start()
+    def unsubscribe(self):
+        with self.condition:
+            self.streams -= 1
+    def wait(self, last, timeout):
+        """Wait until the state differs from last or the timeout expires, and return it."""
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.state is None or self.state == last:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.state
+    def publish(self, state):
+        with self.condition:
+            if state != self.state:
+                self.state = state
+                self.condition.notify_all()
+    def watching(self):
+        """Return True while there are streams, or clear the thread and return False."""
+        with self.condition:
+            if self.streams > 0:
+                return True
+            self.thread = None
+            self.state = None
+            return False
+    def run(self):
+        while self.watching():
+            try:
+                db = _database(pooled=False)
+                with db:
+                    db.listen()
+                    while self.watching():
+                        now = datetime.now()
+                        self.publish(_pushstate(db, now))
+                        # wake up for the next minute, or earlier if the data changes
+                        db.wait(60 - now.second - now.microsecond / 1e6)
+                    # watching() has cleared the thread already
+                    return
+            except infopage.DATABASE_ERRORS + (IOError, OSError) as e:
+                sys.stderr.write("Push watcher failed: {error}\n".format(error=str(e)))
+                time.sleep(5)
+
+_pushhub = _PushHub()
+
+def _push():
+	"""
+	Return the chunks of a push stream, see push().
+	Returns None if this process already serves the maximum number of streams.
+	"""
+	if not _pushhub.available(int(infopage.database(cached=True).getconfig('pushstreams'))):
+		return None
+	return _pushstream()
+
+def _pushstream():
+	"""Generate the chunks of a push stream, from the state published by the watcher thread."""
+	_pushhub.subscribe()
+	try:
+		deadline = time.time() + _PUSH_DURATION
+		yield 'retry: 5000\n\n'
+		last = None
+		while time.time() < deadline:
+			state = _pushhub.wait(last, deadline - time.time())
+			if state is not None and state != last:
+				yield 'data: ' + json.dumps(state) + '\n\n'
+				last = state
+	finally:
+		_pushhub.unsubscribe()
+
+def push(req):
+	"""
+	Server-Sent Events stream announcing data version and minute changes.
+	
+	Each message is a JSON object with the keys version, slides (the number
+	of active slides) and minute. Displays can keep showing their local copies
+	of the slides until the next message arrives.
+	If the process already serves the maximum number of streams (see the
+	pushstreams setting), the request fails and the display polls instead.
+	Push streams are disabled by default, since each one pins an Apache child.
+	"""
+	chunks = _push()
+	if chunks is None:
+		raise apache.SERVER_RETURN(apache.HTTP_SERVICE_UNAVAILABLE)
+	req.content_type = 'text/event-stream'
+	req.headers_out['Cache-Control'] = 'no-cache'
+	for chunk in chunks:
+		req.write(chunk)
+	return ''
+
+def _metrics():
+	"""Return the metrics of this process and the sync counters in the Prometheus text format."""
+	db = _database()
+	with db:
+		settings = db.settings()
+	lines = Infopage.metrics.render()
+	for name, text in _SYNC_COUNTERS:
+		lines.append('# HELP infopage_sync_{0}_total {1}'.format(name, text))
+		lines.append('# TYPE infopage_sync_{0}_total counter'.format(name))
+		lines.append('infopage_sync_{0}_total {1}'.format(name, int(settings.get('sync_' + name) or 0)))
+	if settings.get('sync_time') is not None:
+		lines.append('# HELP infopage_sync_time_seconds Time of the last successful sync, seconds since the epoch')
+		lines.append('# TYPE infopage_sync_time_seconds gauge')
+		lines.append('infopage_sync_time_seconds {0}'.format(int(settings['sync_time'])))
+	lines.append('# HELP infopage_data_version Current data version')
+	lines.append('# TYPE infopage_data_version gauge')
+	lines.append('infopage_data_version {0}'.format(int(settings.get('data_version') or 0)))
+	return '\n'.join(lines) + '\n'
+
+def metrics(req):
+	"""
+	Metrics in the Prometheus text format.
+	
+	Latencies are only recorded if the metrics setting is enabled, and are
+	kept separately by every server process. The sync counters are read
+	from the database and are the same for all processes.
+	"""
+	req.content_type = 'text/plain; version=0.0.4'
+	return _metrics()
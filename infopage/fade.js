@@ -1,6 +1,6 @@
 function fadeouthandler() {
 	this.slide++;
-	this.handle = loadhandler;
+	this.handle = this.load || loadhandler;
 	this.dom.style.animationPlayState = 'running';
 	// For older WebKit browsers
 	this.dom.style.webkitAnimationPlayState = 'running';
@@ -23,10 +23,34 @@ function fadeinhandler() {
 
 function loadhandler() {
 	var state = this;
+	var url = this.url + this.slide;
+	var generation = this.generation;
+	var index = null;
+	if (this.count > 0) {
+		// While the push stream is connected, slides stay valid until the next message
+		index = this.slide % this.count;
+		if (index in this.cache) {
+			this.dom.innerHTML = this.cache[index];
+			this.handle = fadeinhandler;
+			this.handle();
+			return;
+		}
+		url = this.url + index;
+	}
 	var req = new XMLHttpRequest();
 	req.onload = function() {
+		var text = null;
 		if (this.status == 200) {
-			state.dom.innerHTML = this.responseText;
+			text = this.responseText;
+			remember(state, this.getResponseHeader('ETag'), text);
+		} else if (this.status == 304) {
+			text = state.etags[this.getResponseHeader('ETag')] || null;
+		}
+		if (text !== null) {
+			state.dom.innerHTML = text;
+			if (index !== null && generation == state.generation) {
+				state.cache[index] = text;
+			}
 		} else {
 			if (state.debug) {
 				state.dom.innerHTML = this.responseText;
@@ -37,10 +61,68 @@ function loadhandler() {
 		state.handle = fadeinhandler;
 		state.handle();
 	};
-	req.open('get', this.url + this.slide, true);
+	req.open('get', url, true);
+	if (state.etags) {
+		// Let the server answer with 304 Not Modified if we already have the slide
+		var tags = Object.keys(state.etags);
+		if (tags.length > 0) {
+			req.setRequestHeader('If-None-Match', tags.join(', '));
+		}
+	}
 	req.send();
 }
 
+// Keeps the most recent slides by entity tag, for conditional requests
+function remember(state, etag, text) {
+	if (!etag) {
+		return;
+	}
+	if (!state.etags) {
+		state.etags = {};
+		state.etagorder = [];
+	}
+	if (!(etag in state.etags)) {
+		state.etagorder.push(etag);
+		if (state.etagorder.length > 16) {
+			delete state.etags[state.etagorder.shift()];
+		}
+	}
+	state.etags[etag] = text;
+}
+
+function invalidate(state, count) {
+	state.cache = {};
+	state.count = count;
+	state.generation++;
+}
+
+// Push streams hold a server thread each, so pages only subscribe when opened with ?push
+function pushoption(url) {
+	return /[?&]push(=|&|$)/.test(window.location.search) ? url : null;
+}
+
+function subscribe(state, url) {
+	if (!url || !window.EventSource) {
+		return;
+	}
+	var source = new EventSource(url);
+	source.onmessage = function(event) {
+		// Sent whenever the data or the displayed minute changes
+		var update = JSON.parse(event.data);
+		invalidate(state, update.slides);
+	};
+	source.onerror = function() {
+		// Poll for every slide until the stream is reconnected
+		invalidate(state, 0);
+		if (source.readyState == EventSource.CLOSED) {
+			// The server refused the stream, try again later
+			setTimeout(function() {
+				subscribe(state, url);
+			}, 60 * 1000);
+		}
+	};
+}
+
 function emptyhandler() {
 	var state = this;
 	this.dom.addEventListener('animationiteration', function() {
@@ -54,11 +136,11 @@ function emptyhandler() {
 	}, false);
 	// maybe also capture animationend?
 	this.dom.style.opacity = 0.0;
-	this.handle = loadhandler;
+	this.handle = this.load || loadhandler;
 	this.handle();
 }
 
-function loadpage(url, dom, time) {
+function loadpage(url, dom, time, pushurl) {
 	var state = {
 		slide: 0,
 		url: url,
@@ -66,6 +148,266 @@ function loadpage(url, dom, time) {
 		time: time * 1000,
 		handle: emptyhandler,
 		debug: true,
+		cache: {},
+		count: 0,
+		generation: 0,
+	};
+	subscribe(state, pushurl);
+	state.handle();
+}
+
+/*
+ * Client-side rendering
+ *
+ * The playlist contains the slide order and all events until midnight,
+ * so displays only need to contact the server when the data changes.
+ * The masters below are equivalents of the ones in content.py.
+ */
+
+function escapehtml(text) {
+	return String(text === null || text === undefined ? '' : text)
+		.replace(/&/g, '&amp;')
+		.replace(/</g, '&lt;')
+		.replace(/>/g, '&gt;')
+		.replace(/"/g, '&quot;');
+}
+
+function pad(number) {
+	return (number < 10 ? '0' : '') + number;
+}
+
+// Supports the strftime() conversions that make sense for a clock
+function strftime(format, date) {
+	return format.replace(/%([a-zA-Z%])/g, function(match, conversion) {
+		switch (conversion) {
+		case 'H': return pad(date.getHours());
+		case 'I': return pad(date.getHours() % 12 || 12);
+		case 'M': return pad(date.getMinutes());
+		case 'S': return pad(date.getSeconds());
+		case 'p': return date.getHours() < 12 ? 'AM' : 'PM';
+		case 'd': return pad(date.getDate());
+		case 'm': return pad(date.getMonth() + 1);
+		case 'Y': return String(date.getFullYear());
+		case 'y': return pad(date.getFullYear() % 100);
+		case '%': return '%';
+		default: return match;
+		}
+	});
+}
+
+// Timestamps are sent as local time without a timezone
+function parsetime(text) {
+	var parts = text.split(/[^0-9]/);
+	return new Date(parts[0], parts[1] - 1, parts[2], parts[3], parts[4], parts[5]);
+}
+
+function renderpage(title, time, rows) {
+	return '<div id="titlepane"><table><tr>' +
+		'<td class="logo"><img src="logo.png" /></td>' +
+		'<td class="title">' + escapehtml(title) + '</td>' +
+		'<td class="clock">' + escapehtml(time) + '</td>' +
+		'</tr></table></div>' +
+		'<div id="contentpane"><table>' + rows.join('') + '</table></div>';
+}
+
+function rendereventmaster(playlist, slide, now, hasnow) {
+	var settings = playlist.settings;
+	var title = slide.title;
+	var maxrows = parseInt(slide.maxrows !== null ? slide.maxrows : settings.max_rows, 10);
+	var rows = [];
+	if (slide.roomname !== null) {
+		title = slide.roomname;
+	}
+	if (slide.room !== null) {
+		var running = null;
+		var after = [];
+		for (var i = 0; i < playlist.events.length; i++) {
+			var event = playlist.events[i];
+			if (event.room == slide.room) {
+				if (running === null && event.begins <= now && event.ends >= now) {
+					running = event;
+				}
+				if (event.begins >= now) {
+					after.push(event);
+				}
+			}
+		}
+		if (hasnow && running !== null) {
+			rows.push(rendereventrow('desc', running.name, settings.now_text));
+			maxrows--;
+		}
+		for (var j = 0; j < after.length && j < maxrows; j++) {
+			rows.push(rendereventrow('desc', after[j].name, strftime(settings.time_format, after[j].begins)));
+		}
+	}
+	return renderpage(title, strftime(settings.time_format, now), rows);
+}
+
+function rendereventrow(style, description, start) {
+	return '<tr><td class="' + style + '"><div class="cell">' + escapehtml(description) + '</div></td>' +
+		'<td class="time">' + escapehtml(start) + '</td></tr>';
+}
+
+function rendernowmaster(playlist, slide, now) {
+	var settings = playlist.settings;
+	var title = slide.title !== null ? slide.title : settings.now_master_text;
+	var maxrows = parseInt(slide.maxrows !== null ? slide.maxrows : settings.max_rows, 10);
+	var rows = [];
+	for (var i = 0; i < playlist.events.length && rows.length < maxrows; i++) {
+		var event = playlist.events[i];
+		if (event.begins <= now && event.ends >= now) {
+			var style = event.name.length > 14 ? 'roomlong' : 'room';
+			rows.push('<tr><td class="nowdesc"><div class="cell">' + escapehtml(event.name) + '</div></td>' +
+				'<td class="room"><div class="' + style + '">' + escapehtml(event.roomname) + '</div></td></tr>');
+		}
+	}
+	return renderpage(title, strftime(settings.time_format, now), rows);
+}
+
+var masters = [
+	function(playlist, slide, now) { return rendereventmaster(playlist, slide, now, true); },
+	function(playlist, slide, now) { return rendereventmaster(playlist, slide, now, false); },
+	rendernowmaster,
+];
+
+function fetchplaylist(state, done) {
+	var req = new XMLHttpRequest();
+	req.onloadend = function() {
+		if (done) {
+			done();
+		}
+	};
+	req.onload = function() {
+		if (this.status == 200) {
+			var playlist = JSON.parse(this.responseText);
+			for (var i = 0; i < playlist.events.length; i++) {
+				playlist.events[i].begins = parsetime(playlist.events[i].begins);
+				playlist.events[i].ends = parsetime(playlist.events[i].ends);
+			}
+			state.playlist = playlist;
+		}
+		// On errors, keep showing the last playlist
+	};
+	req.open('get', state.url, true);
+	req.send();
+}
+
+function drawhandler() {
+	var now = new Date();
+	var playlist = this.playlist;
+	if (playlist !== null) {
+		var empty = { master: 0, title: null, room: null, roomname: null, maxrows: null };
+		var slide = playlist.slides.length > 0 ? playlist.slides[this.slide % playlist.slides.length] : empty;
+		var master = masters[slide.master] || masters[0];
+		this.dom.innerHTML = master(playlist, slide, now);
+	}
+	this.handle = fadeinhandler;
+	this.handle();
+}
+
+function renderhandler() {
+	var state = this;
+	var now = new Date();
+	this.handle = drawhandler;
+	if (this.playlist === null) {
+		// Nothing to show yet, wait for the first playlist
+		this.fetched = now;
+		fetchplaylist(this, function() {
+			state.handle();
+		});
+		return;
+	}
+	if (strftime('%Y-%m-%d', now) != this.playlist.date || now - this.fetched > this.refresh) {
+		// Refresh in the background, the current slide is rendered from the old copy
+		this.fetched = now;
+		fetchplaylist(this, null);
+	}
+	this.handle();
+}
+
+function loadplaylist(url, dom, time, pushurl) {
+	var state = {
+		slide: 0,
+		url: url,
+		dom: dom,
+		time: time * 1000,
+		handle: emptyhandler,
+		load: renderhandler,
+		debug: false,
+		playlist: null,
+		fetched: 0,
+		// Refetch periodically when no push stream is available
+		refresh: 300 * 1000,
+		version: null,
+	};
+	if (pushurl && window.EventSource) {
+		var source = new EventSource(pushurl);
+		source.onmessage = function(event) {
+			var update = JSON.parse(event.data);
+			if (update.version !== state.version) {
+				state.version = update.version;
+				state.fetched = 0;
+			}
+		};
+	}
+	state.handle();
+}
+
+/*
+ * Prerendered slides
+ *
+ * prerender.py writes every slide into a static file once per minute,
+ * together with index.json containing the number of slides, so the web
+ * server can deliver them without running any code.
+ */
+
+function fetchstatic(url, done) {
+	var req = new XMLHttpRequest();
+	req.onload = function() {
+		done(this.status == 200 ? this.responseText : null);
+	};
+	req.onerror = function() {
+		done(null);
+	};
+	req.open('get', url, true);
+	// The files are replaced every minute, so always revalidate cached copies
+	req.setRequestHeader('Cache-Control', 'no-cache');
+	req.send();
+}
+
+function statichandler() {
+	var state = this;
+	this.handle = fadeinhandler;
+	fetchstatic(this.url + 'index.json', function(text) {
+		if (text !== null) {
+			state.slides = JSON.parse(text).slides;
+		}
+		if (!(state.slides > 0)) {
+			// Nothing has been rendered yet
+			state.dom.innerHTML = '';
+			state.handle();
+			return;
+		}
+		fetchstatic(state.url + (state.slide % state.slides) + '.html', function(text) {
+			// On errors, keep showing the last slide
+			if (text !== null) {
+				state.dom.innerHTML = text;
+			}
+			state.handle();
+		});
+	});
+}
+
+function loadstatic(url, dom, time) {
+	var state = {
+		slide: 0,
+		url: url,
+		dom: dom,
+		time: time * 1000,
+		handle: emptyhandler,
+		load: statichandler,
+		debug: false,
+		slides: 0,
 	};
 	state.handle();
 }
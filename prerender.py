@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# Renders all active slides into static files, so the web server can deliver
+# them without running any Python code (see static.html).
+# Slides are rendered at the start of every minute and whenever the data changes.
+
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import datetime
+from infopage import Snapshot, DATABASE_ERRORS, database
+
+# content.py is either in the infopage/ subdirectory (like in the repository)
+# or in the web root of the Docker image
+WEBROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'infopage')
+if not os.path.isfile(os.path.join(WEBROOT, 'content.py')):
+    WEBROOT = '/var/www/html'
+
+def writefile(name, data):
+    """Replace a file atomically, so the web server never delivers a partial copy."""
+    temp = name + '.tmp'
+    with open(temp, 'wb') as fh:
+        fh.write(data.encode('utf-8'))
+    os.rename(temp, name)
+
+def render(db, output, now):
+    """
+    Render every active slide into the output directory.
+
+    The slides are written as 0.html, 1.html, ... in sequence order, followed
+    by index.json with the number of slides. Files of slides that have been
+    removed are deleted afterwards.
+    Returns the number of slides.
+    """
+    count = db.activeslides()
+    for index in range(count):
+        # any positive counter selects the slide with sequence number counter % count
+        frame = db.frame(count + index, now)
+        page = content._render(frame, now)
+        if page is not None:
+            writefile(os.path.join(output, '{0}.html'.format(index)), page)
+    writefile(os.path.join(output, 'index.json'), json.dumps({
+        'slides': count,
+        'version': db.dataversion(),
+        'minute': now.strftime('%Y-%m-%d %H:%M'),
+    }))
+    for name in os.listdir(output):
+        base, ext = os.path.splitext(name)
+        if ext == '.html' and base.isdigit() and int(base) >= count:
+            os.remove(os.path.join(output, name))
+    return count
+
+parser = argparse.ArgumentParser(description="Render all slides into static files")
+parser.add_argument("-f", "--config", help="specifies the configuration file name (default is /etc/infopage.conf)")
+parser.add_argument("-d", "--database", help="specifies the PostgreSQL database name")
+parser.add_argument("-u", "--user", help="specifies the database user name")
+parser.add_argument("-r", "--host", help="specifies the database host (local if not set)")
+parser.add_argument("-p", "--password", help="specifies the database password (passwordless login if not set)")
+parser.add_argument("-w", "--webroot", default=WEBROOT, help="specifies the directory containing content.py (default: {0})".format(WEBROOT))
+parser.add_argument("-o", "--output", help="specifies the output directory (default: static/ in the web root)")
+parser.add_argument("-1", "--once", help="render once and exit, instead of rendering every minute and after every change", action="store_true")
+parser.add_argument("-v", "--verbose", help="prints the number of slides after each rendering", action="store_true")
+args = parser.parse_args()
+
+sys.path.insert(0, args.webroot)
+import content
+
+output = args.output or os.path.join(args.webroot, 'static')
+if not os.path.isdir(output):
+    os.makedirs(output)
+
+db = database(args.config)
+if args.database:
+    db.setconfig('dbname', args.database)
+if args.user:
+    db.setconfig('dbuser', args.user)
+if args.host:
+    db.setconfig('dbhost', args.host)
+if args.password:
+    db.setconfig('dbpassword', args.password)
+if db.config.get('snapshot'):
+    # render from the read-only snapshot, without connecting to the database
+    db = Snapshot(db.config['snapshot'], db.config)
+
+while True:
+    try:
+        with db:
+            db.listen()
+            while True:
+                now = datetime.now()
+                count = render(db, output, now)
+                if args.verbose:
+                    print("Rendered {count} slides at {now}".format(count=count, now=now.strftime('%H:%M:%S')))
+                if args.once:
+                    sys.exit(0)
+                # wake up for the next minute, or earlier if the data changes
+                db.wait(60 - now.second - now.microsecond / 1e6)
+    except DATABASE_ERRORS + (IOError, OSError) as e:
+        if args.once:
+            raise
+        sys.stderr.write("Rendering failed: {error}\n".format(error=str(e)))
+        time.sleep(10)
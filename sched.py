@@ -3,15 +3,24 @@
 import requests
 import sys
 import re
-import json
-import psycopg2
+import time
+import random
 import argparse
+import requests.adapters
+from multiprocessing.pool import ThreadPool
 from uuid import UUID
-from datetime import datetime
-from infopage import Infopage
+from datetime import datetime, timedelta
+import infopage
+from infopage import SYNC_LOCK, database
 
 useragent = 'sched.py/0.0.1'
 
+EPOCH = datetime(1970, 1, 1)
+# the config table key where the sync cursor is stored (seconds since the epoch)
+CURSOR_KEY = 'sched_last_update'
+# fetch changes from slightly before the last sync to allow for clock skew
+CURSOR_OVERLAP = timedelta(minutes=1)
+
 class ApiCallError(Exception):
     def __init__(self, value):
         self.value = value
@@ -28,25 +37,31 @@ class Sched(object):
     EXPORT_API = 'https://{event}.sched.org/api/session/export'
     SYNC_API = 'https://{event}.sched.org/api/site/sync'
 
-    def __init__(self, event, api_key, user_agent=None):
+    def __init__(self, event, api_key, user_agent=None, last_update=None, workers=4):
         # the first fetch should be unconditional, so start with the epoch
-        self.last_update = datetime.fromtimestamp(0)
+        if last_update is None:
+            last_update = EPOCH
+        # all timestamps are naive UTC, so they can be compared to EPOCH
+        self.last_update = last_update
         self.api_key = api_key
         self.user_agent = user_agent
+        self.workers = workers
         self.export_url = self.EXPORT_API.format(event=event)
         self.sync_url = self.SYNC_API.format(event=event)
+        # reuse connections across requests and worker threads
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=workers))
+        if user_agent is not None:
+            self.session.headers['User-Agent'] = user_agent
 
-    def api_session_export(self, limit=-1):
-        headers = { }
-        if self.user_agent is not None:
-            headers['User-Agent'] = self.user_agent
+    def fetch_session_export(self, page=None, limit=-1):
+        """Fetch one page of the session export and return the raw records."""
         fields = 'event_key,id,active,start_time_ts,end_time_ts,name,venue_id,venue'
-        now = datetime.now()
-        params = { 'api_key': self.api_key, 'format': 'json', 'strip_html': 1, 'fields': fields, 'since': int((self.last_update - datetime(1970, 1, 1)).total_seconds()) }
+        params = { 'api_key': self.api_key, 'format': 'json', 'strip_html': 1, 'fields': fields, 'since': int((self.last_update - EPOCH).total_seconds()) }
         if limit != -1:
-            params['page'] = 1
+            params['page'] = page or 1
             params['limit'] = limit
-        r = requests.get(self.export_url, headers=headers, params=params)
+        r = self.session.get(self.export_url, params=params)
         if r.status_code != 200:
             raise ApiCallError("Error exporting session: HTTP error: {status}".format(status=r.status_code))
         match = self.ERR_MATCH.match(r.content)
@@ -55,21 +70,134 @@ class Sched(object):
             raise ApiCallError("Error exporting session: Call error: {error}".format(error=error))
         else:
             try:
-                data = r.json()
-                for e in data:
-                    # Mangle data into standard types
-                    e['start_time'] = datetime.fromtimestamp(e['start_time_ts'])
-                    e['end_time'] = datetime.fromtimestamp(e['end_time_ts'])
-                    e['active'] = e['active'].upper() == 'Y'
-                    # Why is this a UUID?
-                    e['id'] = UUID(e['id'])
-                    # Why is this a string?
-                    e['venue_id'] = int(e['venue_id'])
-                self.last_update = now
-                return data
+                return r.json()
             except ValueError as e:
                 raise ApiCallError("Error exporting session: Invalid data: {exception}".format(exception=str(e)))
 
+    @staticmethod
+    def mangle(e):
+        """Convert an exported session record into the format expected by Infopage.update()."""
+        try:
+            # Mangle data into standard types
+            e['start_time'] = datetime.fromtimestamp(e['start_time_ts'])
+            e['end_time'] = datetime.fromtimestamp(e['end_time_ts'])
+            e['active'] = e['active'].upper() == 'Y'
+            # Why is this a UUID?
+            e['id'] = UUID(e['id'])
+            # Why is this a string?
+            e['venue_id'] = int(e['venue_id'])
+            return e
+        except ValueError as ex:
+            raise ApiCallError("Error exporting session: Invalid data: {exception}".format(exception=str(ex)))
+
+    def api_session_export(self, limit=-1, page=1):
+        """Fetch the session export (or a single page of it) as a list."""
+        now = datetime.utcnow()
+        data = [ self.mangle(e) for e in self.fetch_session_export(page, limit) ]
+        self.last_update = now
+        return data
+
+    def sessions(self, limit=500):
+        """
+        Fetch all pages of the session export and generate the records one by one.
+        
+        Pages are requested concurrently, up to the number of workers at a time,
+        until a page comes back incomplete. Only that many pages are held in memory.
+        The sync cursor is advanced once the last record has been consumed.
+        """
+        now = datetime.utcnow()
+        pool = ThreadPool(self.workers)
+        try:
+            page = 1
+            complete = False
+            while not complete:
+                pages = range(page, page + self.workers)
+                for data in pool.imap(lambda p: self.fetch_session_export(p, limit), pages):
+                    for e in data:
+                        yield self.mangle(e)
+                    if len(data) < limit:
+                        complete = True
+                        break
+                page += self.workers
+        finally:
+            pool.terminate()
+        self.last_update = now
+
+def sync(db, sched, fresh=False, page_size=500):
+    """
+    Fetch changed sessions and write them into the database.
+    
+    Continues where the last successful sync left off, unless fresh is set.
+    A fresh sync fetches the complete session list and deletes all events
+    that are no longer in it.
+    Returns the change counts reported by Infopage.update().
+    The results are added to the sync counters (see Infopage.recordsync()),
+    events older than the retention window are archived, and the read-only
+    snapshot is updated if anything has changed.
+    """
+    sched.last_update = EPOCH
+    cursor = db.setting(CURSOR_KEY)
+    if cursor is not None and not fresh:
+        sched.last_update = max(EPOCH, EPOCH + timedelta(seconds=int(cursor)) - CURSOR_OVERLAP)
+    if page_size > 0:
+        session = sched.sessions(page_size)
+    else:
+        session = sched.api_session_export()
+    try:
+        counts = db.update(session, prune=fresh)
+    except infopage.ConflictError:
+        db.recordsync({ 'conflicts': 1 }, False)
+        raise
+    # only advance the cursor once the update has been committed
+    db.setsetting(CURSOR_KEY, str(int((sched.last_update - EPOCH).total_seconds())))
+    db.recordsync(counts)
+    db.archive()
+    db.publish(fresh or sum(counts.values()) > 0)
+    return counts
+
+def daemon(db, sched, args):
+    """
+    Sync forever, keeping the database connection and HTTP session open.
+    
+    Polls every --min-interval seconds while sessions are running or changes
+    are coming in, and backs off exponentially up to --max-interval otherwise.
+    The sync lock is only held during each sync, so csv_import.py and one-shot
+    syncs can run in between. A sync is skipped while another one holds the lock.
+    """
+    interval = args.min_interval
+    fresh = args.overwrite or args.clear
+    clear = args.clear
+    while True:
+        try:
+            if db.conn is None:
+                db.connect()
+            if not db.trylock(SYNC_LOCK):
+                if args.verbose:
+                    print("Another syncer is running, skipping this sync")
+                interval = args.min_interval
+            else:
+                try:
+                    if clear:
+                        db.clear(True)
+                        clear = False
+                    counts = sync(db, sched, fresh, args.page_size)
+                finally:
+                    db.unlock(SYNC_LOCK)
+                fresh = False
+                if args.verbose:
+                    print("Inserted {inserted}, updated {updated}, deleted {deleted} events".format(**counts))
+                if sum(counts.values()) > 0 or db.running(datetime.now(), timedelta(seconds=args.max_interval)):
+                    interval = args.min_interval
+                else:
+                    interval = min(interval * 2, args.max_interval)
+        except (ApiCallError, infopage.ConflictError, requests.RequestException) + infopage.DATABASE_ERRORS as e:
+            sys.stderr.write("Sync failed: {error}\n".format(error=str(e)))
+            # start over with a fresh connection after errors
+            db.close()
+            interval = min(interval * 2, args.max_interval)
+        # spread out the requests of multiple installations
+        time.sleep(interval * random.uniform(0.8, 1.2))
+
 parser = argparse.ArgumentParser()
 parser.add_argument("-f", "--config", help="specifies the configuration file name (default is /etc/infopage.conf)")
 parser.add_argument("-e", "--event", help="specifies the name of the event on sched.org")
@@ -78,14 +206,19 @@ parser.add_argument("-d", "--database", help="specifies the PostgreSQL database
 parser.add_argument("-u", "--user", help="specifies the database user name")
 parser.add_argument("-r", "--host", help="specifies the database host (local if not set)")
 parser.add_argument("-p", "--password", help="specifies the database password (passwordless login if not set)")
-parser.add_argument("-o", "--overwrite", help="starts with a fresh event list (rooms and slides will be kept)", action="store_true")
+parser.add_argument("-o", "--overwrite", help="fetches the complete event list and deletes events that are no longer in it (rooms and slides will be kept)", action="store_true")
 parser.add_argument("-c", "--clear", help="clears all events, rooms and slides (use this before the first import)", action="store_true")
 parser.add_argument("-l", "--list", help="lists all rooms", action="store_true")
 parser.add_argument("-s", "--slides", help="stores a slide order into the database, separated by a comma, specify -1 for the 'now' slide (use the -l option to list the slide numbers)")
+parser.add_argument("-n", "--page-size", type=int, default=500, help="number of sessions per export page, 0 fetches everything in one request (default: 500)")
+parser.add_argument("-w", "--workers", type=int, default=4, help="number of export pages fetched concurrently (default: 4)")
+parser.add_argument("-v", "--verbose", help="prints the number of inserted, updated and deleted events after each sync", action="store_true")
+parser.add_argument("-D", "--daemon", help="keep running and sync periodically instead of exiting after one sync", action="store_true")
+parser.add_argument("--min-interval", type=int, default=60, help="daemon polling interval while sessions are running or changing, in seconds (default: 60)")
+parser.add_argument("--max-interval", type=int, default=1800, help="maximum daemon polling interval when nothing changes, in seconds (default: 1800)")
 args = parser.parse_args()
 
-db = Infopage()
-db.loadconfig(args.config)
+db = database(args.config)
 if args.database:
 	db.setconfig('dbname', args.database)
 if args.user:
@@ -115,13 +248,21 @@ with db:
 			else:
 				order.append({ 'room': int(s), 'master': 0 })
 		db.slides(order)
+		db.publish()
 
 	else:
-		if args.overwrite:
-			db.clear()
-		if args.clear:
-			db.clear(True)
-
-		sched = Sched(db.getconfig('schedevent'), db.getconfig('schedkey'), useragent)
-		session = sched.api_session_export()
-		db.update(session)
+		sched = Sched(db.getconfig('schedevent'), db.getconfig('schedkey'), useragent, workers=args.workers)
+		if args.daemon:
+			# the daemon takes the lock for each sync
+			daemon(db, sched, args)
+		else:
+			if not db.trylock(SYNC_LOCK):
+				sys.stderr.write("Another syncer is running, exiting.\n")
+				sys.exit(1)
+
+			if args.clear:
+				db.clear(True)
+
+			counts = sync(db, sched, args.overwrite or args.clear, args.page_size)
+			if args.verbose:
+				print("Inserted {inserted}, updated {updated}, deleted {deleted} events".format(**counts))
@@ -1,20 +1,22 @@
 #!/usr/bin/env python
 
 import sys
-from infopage import Infopage
+from infopage import database
 
 if len(sys.argv) > 1 and '-h' in sys.argv[1:]:
-    print "Usage: schema.py [-d]"
-    print "-d     Drops all tables before recreating them"
+    print("Usage: schema.py [-d]")
+    print("-d     Drops all tables before recreating them")
+    print("Pending schema migrations are always applied.")
     sys.exit(1)
 
 dropping = len(sys.argv) > 1 and '-d' in sys.argv[1:]
 
-ip = Infopage()
-ip.loadconfig()
+ip = database()
 with ip:
 	if dropping:
 		ip.dropall()
 	ip.createschema()
+	for version in ip.migrate():
+		print("Applied schema migration %d" % version)
 	if dropping:
 		ip.insertdefault()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# Conformance tests for the database backends.
+#
+# The same checks of the Infopage API run against the SQLite backend, and
+# against PostgreSQL if INFOPAGE_TEST_DATABASE names a throwaway database.
+# WARNING: All tables in that database are dropped.
+#
+#   python -m unittest discover tests
+#   bench/postgres.sh env INFOPAGE_TEST_DATABASE=infopage python -m unittest discover tests
+
+import os
+import sys
+import uuid
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import infopage
+from infopage import Infopage, SqliteInfopage, Snapshot, ConflictError
+
+TEST_NS = uuid.UUID('6ba7b810-9dad-11d1-80b4-eeeeeeeeeeee')
+# far enough in the future that no event has ended when the in-memory index is loaded
+START = datetime(2030, 6, 1, 9, 0)
+
+def event(i, room=1, begins=START, minutes=30, name=None, active=True):
+    """Return an event in the format expected by Infopage.update()."""
+    return {
+        'id': uuid.uuid5(TEST_NS, str(i)),
+        'name': name or u"Event {0}".format(i),
+        'venue_id': room,
+        'venue': u"Room {0}".format(room),
+        'active': active,
+        'start_time': begins,
+        'end_time': begins + timedelta(minutes=minutes),
+    }
+
+def names(frame):
+    """Return the event names of a frame, for comparisons."""
+    events = frame['events']
+    now = events['now'] and events['now']['name']
+    return (now, [ e['name'] for e in events['after'] ], [ (e['name'], e['room']) for e in events['current'] ])
+
+class BackendTests(object):
+    """Checks shared by all backends, mixed into a TestCase by each of them."""
+
+    def open(self):
+        """Return a connection to the database of the backend under test."""
+        raise NotImplementedError()
+
+    def setUp(self):
+        # the caches are keyed by database and data version, which repeat between tests
+        Infopage.settingscache.clear()
+        Infopage.slidecounts.clear()
+        Infopage.indexes.clear()
+        Snapshot.loaded.clear()
+        self.temp = tempfile.mkdtemp()
+        self.db = self.open()
+        self.db.dropall()
+        self.db.createschema()
+        self.db.migrate()
+        self.db.insertdefault()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.temp)
+
+    def test_migrate(self):
+        self.assertEqual(self.db.schemaversion(), Infopage.MIGRATIONS[-1][0])
+        self.assertEqual(self.db.migrate(), [ ])
+
+    def test_update(self):
+        events = [ event(i, room=1 + i % 2, begins=START + timedelta(minutes=30 * i)) for i in range(5) ]
+        for bulk in (True, False):
+            self.db.clear(True)
+            self.assertEqual(self.db.update(events, bulk=bulk), { 'inserted': 5, 'updated': 0, 'deleted': 0 })
+            version = self.db.dataversion()
+            # importing the same events again changes nothing
+            self.assertEqual(self.db.update(events, bulk=bulk), { 'inserted': 0, 'updated': 0, 'deleted': 0 })
+            self.assertEqual(self.db.dataversion(), version)
+            changed = [ event(0, name=u"Renamed"), event(1, room=2, begins=events[1]['start_time'], active=False) ]
+            self.assertEqual(self.db.update(changed, bulk=bulk), { 'inserted': 0, 'updated': 1, 'deleted': 1 })
+            self.assertTrue(self.db.dataversion() > version)
+            playlist = self.db.playlist(START, START + timedelta(days=1))
+            self.assertEqual([ e['name'] for e in playlist['events'] ], [ u"Renamed", u"Event 2", u"Event 3", u"Event 4" ])
+            self.assertEqual(sorted([ r['id'] for r in self.db.rooms() ]), [ 1, 2 ])
+
+    def test_prune(self):
+        self.db.update([ event(i) for i in range(3) ])
+        self.assertEqual(self.db.update([ event(1) ], prune=True), { 'inserted': 0, 'updated': 0, 'deleted': 2 })
+        self.assertEqual(len(self.db.playlist(START, START + timedelta(days=1))['events']), 1)
+
+    def test_conflict(self):
+        self.db.update([ event(0) ])
+        renamed = event(1)
+        renamed['venue'] = u"Other name"
+        for bulk in (True, False):
+            self.assertRaises(ConflictError, self.db.update, [ event(2), renamed ], bulk=bulk)
+        self.assertEqual(len(self.db.playlist(START, START + timedelta(days=1))['events']), 1)
+
+    def test_frame(self):
+        self.db.update([
+            event(0, room=1, begins=START, minutes=60, name=u"Running"),
+            event(1, room=1, begins=START + timedelta(hours=1), name=u"Next"),
+            event(2, room=2, begins=START, minutes=90, name=u"Elsewhere"),
+            event(3, room=1, begins=START, minutes=60, name=u"Tied"),
+        ])
+        self.db.slides([ { 'room': 1, 'master': 0 }, { 'room': None, 'master': 2 }, { 'room': 1, 'master': 2 } ])
+        self.assertEqual(self.db.activeslides(), 3)
+        # events starting at the same time are ordered by id
+        first = sorted([ (event(0)['id'], u"Running"), (event(3)['id'], u"Tied") ])[0][1]
+        now = START + timedelta(minutes=10)
+        room = self.db.frame(3, now)
+        self.assertEqual(room['selector']['slide'], 0)
+        self.assertEqual(room['slide']['room'], 1)
+        self.assertEqual(names(room), (first, [ u"Next" ], [ ]))
+        current = self.db.frame(4, now)
+        self.assertEqual(current['selector']['master'], 2)
+        running = [ (name, room) for eid, name, room in sorted([ (event(0)['id'], u"Running", u"Room 1"), (event(2)['id'], u"Elsewhere", u"Room 2"), (event(3)['id'], u"Tied", u"Room 1") ]) ]
+        self.assertEqual(names(current)[2], running)
+        # the "now" master ignores the room of its slide
+        self.assertEqual(names(self.db.frame(5, now))[2], running)
+        for counter in (None, '', 3, 4, 5, '7'):
+            self.assertEqual(names(self.db.indexedframe(counter, now)), names(self.db.frame(counter, now)))
+
+    def test_generations(self):
+        self.db.update([ event(0), event(1) ])
+        version = self.db.dataversion()
+        generation = self.db.stage()
+        self.db.update([ event(1, name=u"Staged"), event(2) ], generation=generation)
+        # readers don't see the staged generation
+        self.assertEqual(self.db.dataversion(), version)
+        self.assertEqual([ e['name'] for e in self.db.playlist(START, START + timedelta(days=1))['events'] ], [ u"Event 0", u"Event 1" ])
+        self.db.switch(generation)
+        self.assertTrue(self.db.dataversion() > version)
+        self.assertEqual(sorted([ e['name'] for e in self.db.playlist(START, START + timedelta(days=1))['events'] ]), [ u"Event 0", u"Event 2", u"Staged" ])
+        discarded = self.db.stage(copy=False)
+        self.db.update([ event(3) ], generation=discarded)
+        self.db.discard(discarded)
+        self.assertRaises(ValueError, self.db.discard, generation)
+        self.assertEqual(len(self.db.playlist(START, START + timedelta(days=1))['events']), 3)
+
+    def test_archive(self):
+        past = datetime(2020, 1, 1, 9, 0)
+        self.db.update([ event(0, begins=past), event(1, begins=past), event(2) ])
+        # archiving is disabled by default
+        self.assertEqual(self.db.archive(), 0)
+        self.db.setsetting('retention_days', '1')
+        self.assertEqual(self.db.archive(), 2)
+        # unchanged past events are not imported again, rescheduled ones are
+        self.assertEqual(self.db.update([ event(0, begins=past), event(1) ])['inserted'], 1)
+        self.assertEqual(len(self.db.playlist(past, START + timedelta(days=1))['events']), 2)
+
+    def test_recordsync(self):
+        self.db.recordsync({ 'inserted': 2, 'updated': 1, 'deleted': 0 })
+        self.db.recordsync({ 'conflicts': 1 }, False)
+        settings = self.db.settings()
+        self.assertEqual([ int(settings['sync_' + name]) for name in ('inserted', 'updated', 'deleted', 'conflicts') ], [ 2, 1, 0, 1 ])
+        self.assertTrue(int(settings['sync_time']) > 0)
+
+    def test_lock(self):
+        self.assertTrue(self.db.trylock(infopage.SYNC_LOCK))
+        other = self.open()
+        try:
+            self.assertFalse(other.trylock(infopage.SYNC_LOCK))
+            self.db.unlock(infopage.SYNC_LOCK)
+            self.assertTrue(other.trylock(infopage.SYNC_LOCK))
+        finally:
+            other.close()
+
+    def test_snapshot(self):
+        self.db.update([ event(0, minutes=60), event(1, begins=START + timedelta(hours=1)) ])
+        self.db.slides([ { 'room': 1, 'master': 0 } ])
+        path = os.path.join(self.temp, 'snapshot.db')
+        self.db.export(path)
+        now = START + timedelta(minutes=10)
+        with Snapshot(path) as snapshot:
+            self.assertEqual(snapshot.dataversion(), self.db.dataversion())
+            self.assertEqual(names(snapshot.frame(1, now)), names(self.db.frame(1, now)))
+
+class SqliteTests(BackendTests, unittest.TestCase):
+    def open(self):
+        db = SqliteInfopage()
+        db.setconfig('dbfile', os.path.join(self.temp, 'infopage.db'))
+        db.connect()
+        return db
+
+@unittest.skipUnless(infopage.psycopg2 is not None and os.environ.get('INFOPAGE_TEST_DATABASE'), "set INFOPAGE_TEST_DATABASE to test the PostgreSQL backend")
+class PostgresTests(BackendTests, unittest.TestCase):
+    def open(self):
+        db = Infopage()
+        db.setconfig('dbname', os.environ['INFOPAGE_TEST_DATABASE'])
+        db.connect()
+        return db
+
+if __name__ == '__main__':
+    unittest.main()
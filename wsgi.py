@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""
+WSGI application serving infopage without Apache and mod_python.
+
+It answers the same URLs as the mod_python publisher setup, so the pages in
+infopage/ work unchanged, and it serves the static files from that directory.
+All threads of a worker process share the connection pool and caches, so
+prefer few processes with several threads each. A request waits for a free
+connection when all of them are in use, and every push stream occupies a
+thread, so use the poolsize setting (4 by default) plus the pushstreams
+setting as the number of threads. Push streams are disabled by default, set
+"pushstreams": 8 and point the displays to index.html?push to enable them:
+
+    gunicorn --workers 2 --threads 12 --bind 0.0.0.0:8080 wsgi:application
+
+For a quick test without any additional software:
+
+    python wsgi.py 8080
+"""
+
+import os
+import sys
+import mimetypes
+try:
+    from urlparse import parse_qs
+except ImportError:
+    from urllib.parse import parse_qs
+
+# content.py is in the web root, which is either next to this file (like in
+# the Docker image) or in the infopage/ subdirectory (like in the repository)
+WEBROOT = os.path.dirname(os.path.abspath(__file__))
+if os.path.isfile(os.path.join(WEBROOT, 'infopage', 'content.py')):
+    WEBROOT = os.path.join(WEBROOT, 'infopage')
+sys.path.insert(0, WEBROOT)
+import content
+
+STATUS = {
+    200: '200 OK',
+    304: '304 Not Modified',
+    404: '404 Not Found',
+    503: '503 Service Unavailable',
+}
+STATIC_TYPES = ('.html', '.css', '.js', '.png', '.svg', '.jpg', '.gif', '.ico')
+
+def encode(body):
+    if isinstance(body, bytes):
+        return body
+    return body.encode('utf-8')
+
+def slide(environ, query):
+    etags = content._etags(environ.get('HTTP_IF_NONE_MATCH'))
+    status, headers, page = content._slide(query.get('slide', [ '' ])[0], etags)
+    headers = list(headers.items())
+    if status == 304:
+        return status, headers, [ ]
+    headers.append(('Content-Type', 'text/html; charset=utf-8'))
+    return status, headers, [ encode(page or '') ]
+
+def playlist(environ, query):
+    return 200, [ ('Content-Type', 'application/json') ], [ encode(content._playlist()) ]
+
+def push(environ, query):
+    chunks = content._push()
+    if chunks is None:
+        return 503, [ ('Content-Type', 'text/plain') ], [ b'Push streams are disabled or busy' ]
+    headers = [ ('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-cache') ]
+    return 200, headers, (encode(chunk) for chunk in chunks)
+
+def metrics(environ, query):
+    return 200, [ ('Content-Type', 'text/plain; version=0.0.4') ], [ encode(content._metrics()) ]
+
+def static(path):
+    name = os.path.normpath(os.path.join(WEBROOT, path.lstrip('/') or 'index.html'))
+    if not name.startswith(WEBROOT + os.sep) or os.path.splitext(name)[1] not in STATIC_TYPES or not os.path.isfile(name):
+        return 404, [ ('Content-Type', 'text/plain') ], [ b'Not found' ]
+    with open(name, 'rb') as fh:
+        data = fh.read()
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    return 200, [ ('Content-Type', mimetype), ('Content-Length', str(len(data))) ], [ data ]
+
+ROUTES = {
+    '/content.py/slide': slide,
+    '/content.py/playlist': playlist,
+    '/content.py/push': push,
+    '/content.py/metrics': metrics,
+}
+
+def application(environ, start_response):
+    path = environ.get('PATH_INFO', '/')
+    route = ROUTES.get(path)
+    if route is None:
+        status, headers, body = static(path)
+    else:
+        status, headers, body = route(environ, parse_qs(environ.get('QUERY_STRING', ''), keep_blank_values=True))
+    start_response(STATUS[status], [ (str(name), str(value)) for name, value in headers ])
+    return body
+
+if __name__ == '__main__':
+    from wsgiref.simple_server import make_server, WSGIServer
+    try:
+        from SocketServer import ThreadingMixIn
+    except ImportError:
+        from socketserver import ThreadingMixIn
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+    port = 8080
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    make_server('', port, application, ThreadingWSGIServer).serve_forever()